@@ -0,0 +1,699 @@
+import argparse
+from bleu import BleuAccumulator, compute_bleu, get_corpus_statistics
+from collections import namedtuple
+from data_loader import (
+    load_debug,
+    load_dummy_fixed_length,
+    load_dummy_variable_length,
+    load_iwslt,
+    load_multi30k,
+    tokenize_de_batch,
+    tokenize_dummy_batch,
+    tokenize_en_batch,
+)
+from dataset import tokenize_csv
+from decoding import beam_search, greedy_search
+from device import check_precision, configure_cpu, get_available_cpus, get_grad_scaler, select_device, with_cpu
+from functools import partial
+import json
+from main import compute_batch_loss, get_loss, train_batch
+from model import Attention, EncoderState, Model
+from model_without_attention import ModelWithoutAttention
+import numpy as np
+import os
+from parse import load_vocabularies, save_vocabularies
+import resource
+import shutil
+import socket
+import subprocess
+from summary import BackgroundWriter
+import sys
+import tempfile
+import time
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+from utils import batch2ids, batch2words, filter_words, list2words, pad_sentences, torch2words
+from visualize import visualize_attention
+
+
+Batch = namedtuple('Batch', ['src', 'trg'])
+
+
+def get_dummy_config(hidden_size=256, num_layers=2, window_size=7, vocabulary_size=1000, input_feeding=True,
+                     pack_sequences=False):
+    return {
+        'attention': {'enabled': True, 'window_size': window_size},
+        'input_feeding': input_feeding,
+        'rnn': {
+            'dropout': 0,
+            'hidden_size': hidden_size,
+            'num_layers': num_layers,
+            'pack_sequences': pack_sequences,
+        },
+        'source_vocabulary_size': vocabulary_size,
+        'target_vocabulary_size': vocabulary_size,
+        'teacher_forcing': 1,
+        'window_size': window_size,
+        'EOS': 3,
+        'PAD_src': 1,
+        'PAD_trg': 1,
+        'SOS': 2,
+    }
+
+
+def get_dummy_batch(config, S, T, batch_size, device):
+    vocabulary_size = config.get('source_vocabulary_size')
+    source_lengths = torch.randint(S // 2, S + 1, (batch_size,), device=device, dtype=torch.long)
+    source_lengths, _ = source_lengths.sort(descending=True)
+    source_lengths[0] = S
+    target_lengths = torch.randint(T // 2, T + 1, (batch_size,), device=device, dtype=torch.long)
+    target_lengths[0] = T
+    source = torch.randint(4, vocabulary_size, (S, batch_size), device=device, dtype=torch.long)
+    target = torch.randint(4, vocabulary_size, (T, batch_size), device=device, dtype=torch.long)
+    for i in range(batch_size):
+        source[source_lengths[i]:, i] = config.get('PAD_src')
+        target[target_lengths[i]:, i] = config.get('PAD_trg')
+    return Batch(src=(source, source_lengths), trg=(target, target_lengths))
+
+
+def run_measurement(f, device, args, results):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = f(device, *args)
+    results.put((result, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 2 ** 10))
+
+
+def measure(f, device, *args):
+    """Result of f(device, *args) and the peak memory in MiB it allocated.
+
+    The peak resident set size of a process cannot be reset, so on cpu f runs
+    in a fresh process and the peak is counted from where it was before the call.
+    """
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        result = f(device, *args)
+        return result, torch.cuda.max_memory_allocated(device) / 2 ** 20
+    context = mp.get_context('spawn')
+    results = context.SimpleQueue()
+    process = context.Process(target=run_measurement, args=(f, device, args, results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise Exception(f'Measurement process failed with exit code {process.exitcode}')
+    return results.get()
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def timeit(f, device, repeat):
+    f()
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        f()
+    synchronize(device)
+    return (time.perf_counter() - start) / repeat
+
+
+def time_attention(device, args):
+    hidden_size = args.hidden_size
+    window_size = args.window_size
+    S, T, batch_size = args.source_length, args.target_length, args.batch_size
+    attention = Attention(window_size, hidden_size, device).to(device)
+    encoder_output = torch.randn(S + 2 * window_size + 1, batch_size, hidden_size, device=device, requires_grad=True)
+    decoder_output = torch.randn(T, batch_size, hidden_size, device=device, requires_grad=True)
+    lengths = torch.full((batch_size,), S, device=device, dtype=torch.long)
+
+    def step():
+        encoder_state = EncoderState(encoder_output, lengths, window_size)
+        c = attention(encoder_state, decoder_output, T, batch_size, False)
+        c.sum().backward()
+
+    return timeit(step, device, args.repeat)
+
+
+def benchmark_attention(args, device):
+    seconds, memory = measure(time_attention, device, args)
+    print(f'Attention (S={args.source_length}, T={args.target_length}, batch={args.batch_size}, '
+          f'hidden={args.hidden_size}, window={args.window_size})')
+    print(f'  forward/backward: {seconds * 1000:.2f} ms')
+    print(f'  peak memory: {memory:.1f} MiB')
+
+
+def get_dummy_model(args, device):
+    config = get_dummy_config(
+        args.hidden_size,
+        args.num_layers,
+        args.window_size,
+        input_feeding=args.input_feeding,
+        pack_sequences=args.pack_sequences,
+    )
+    config['teacher_forcing'] = args.teacher_forcing
+    if args.no_attention:
+        model = ModelWithoutAttention(config, device)
+    else:
+        model = Model(config, device)
+    return config, model.to(device)
+
+
+def time_training(device, args):
+    config, model = get_dummy_model(args, device)
+    batch = get_dummy_batch(config, args.source_length, args.target_length, args.batch_size, device)
+    target_batch, target_lengths = batch.trg
+    loss_fn = nn.CrossEntropyLoss(ignore_index=config.get('PAD_trg'))
+    n_tokens = target_lengths.sum().item()
+    model.train()
+
+    def step():
+        model.zero_grad()
+        ys = model(batch)
+        loss = loss_fn(ys.view(-1, ys.size(2)), target_batch.view(-1))
+        loss.backward()
+
+    return timeit(step, device, args.repeat), n_tokens
+
+
+def benchmark_training(args, device):
+    (seconds, n_tokens), memory = measure(time_training, device, args)
+    print(f'Training step (teacher forcing={args.teacher_forcing}, input feeding={args.input_feeding})')
+    print(f'  step: {seconds * 1000:.2f} ms')
+    print(f'  throughput: {n_tokens / seconds:.0f} target tokens/sec')
+    print(f'  peak memory: {memory:.1f} MiB')
+
+
+def saved_activation_memory(f):
+    """MiB of distinct tensors saved for the backward pass while running f."""
+    saved = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        saved[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        f()
+    return sum(saved.values()) / 2 ** 20
+
+
+def time_precision(device, args, precision):
+    # the same seed gives every precision the same model and batch
+    torch.manual_seed(0)
+    config, model = get_dummy_model(args, device)
+    batch = get_dummy_batch(config, args.source_length, args.target_length, args.batch_size, device)
+    config['model'] = model
+    config['loss_fn'] = nn.CrossEntropyLoss(reduction='none')
+    config['optimizer'] = torch.optim.Adam(model.parameters(), lr=1e-4)
+    config['precision'] = precision
+    config['grad_scaler'] = get_grad_scaler(precision)
+    config['gradient_clipping'] = True
+    loss = with_cpu(train_batch(config, [batch])).item()
+    activations = saved_activation_memory(lambda: train_batch(config, [batch]))
+    seconds = timeit(lambda: train_batch(config, [batch]), device, args.repeat)
+    return seconds, loss, activations
+
+
+def benchmark_precision(args, device):
+    print(f'Training step by precision (S={args.source_length}, T={args.target_length}, batch={args.batch_size})')
+    for precision in args.precisions.split(','):
+        check_precision(precision, device)
+        (seconds, loss, activations), memory = measure(time_precision, device, args, precision)
+        print(f'  {precision}: {seconds * 1000:.2f} ms/step, first loss {loss:.4f}, '
+              f'activations {activations:.1f} MiB, peak memory {memory:.1f} MiB')
+
+
+def benchmark_logging(args, device):
+    from tensorboardX import SummaryWriter
+    steps = args.repeat * 100
+    log_every = 10
+    losses = torch.rand(steps, device=device)
+    weights = torch.rand(args.target_length, args.source_length)
+    words = [str(i) for i in range(max(args.source_length, args.target_length))]
+    # import matplotlib before timing
+    visualize_attention(words[:1], words[:1], weights[:1, :1])
+
+    with tempfile.TemporaryDirectory() as path:
+        writer = SummaryWriter(log_dir=f'{path}/synchronous')
+        synchronize(device)
+        start = time.perf_counter()
+        for step in range(steps):
+            writer.add_scalar('loss', with_cpu(losses[step]), step)
+        synchronize(device)
+        synchronous_seconds = (time.perf_counter() - start) / steps
+        start = time.perf_counter()
+        writer.add_figure('attention', visualize_attention(words[:args.source_length], words[:args.target_length], weights), 0)
+        synchronous_figure_seconds = time.perf_counter() - start
+        writer.close()
+
+        writer = BackgroundWriter(f'{path}/background')
+        synchronize(device)
+        start = time.perf_counter()
+        train_losses = 0
+        for step in range(steps):
+            train_losses += losses[step]
+            if (step + 1) % log_every == 0:
+                writer.add_scalar('loss', train_losses / log_every, step)
+                train_losses = 0
+        synchronize(device)
+        background_seconds = (time.perf_counter() - start) / steps
+        start = time.perf_counter()
+        writer.add_figure('attention', partial(visualize_attention, words[:args.source_length], words[:args.target_length], weights), 0)
+        background_figure_seconds = time.perf_counter() - start
+        writer.close()
+
+    print(f'Logging ({steps} steps, loss logged every {log_every} steps in the background)')
+    print(f'  synchronous: {synchronous_seconds * 1e6:.1f} us/step, attention figure {synchronous_figure_seconds * 1000:.1f} ms')
+    print(f'  background: {background_seconds * 1e6:.1f} us/step, attention figure {background_figure_seconds * 1000:.1f} ms')
+
+
+def get_loss_baseline(loss_fn, batch, ys):
+    """The step-wise loss get_loss replaced, with loss_fn reducing every step to its batch mean."""
+    target_batch, target_lengths = batch.trg
+    T, batch_size = target_batch.shape
+    mask = torch.ones(T, batch_size, device=ys.device)
+    for i, length in enumerate(target_lengths):
+        mask[length:, i] = 0
+    losses = torch.empty((T, batch_size), dtype=torch.float, device=ys.device)
+    for i in range(T):
+        losses[i] = loss_fn(ys[i], target_batch[i])
+    return compute_batch_loss(losses, mask, target_lengths)
+
+
+def benchmark_loss(args, device):
+    config = get_dummy_config(vocabulary_size=args.vocabulary_size)
+    config['loss_fn'] = nn.CrossEntropyLoss(reduction='none')
+    baseline_loss_fn = nn.CrossEntropyLoss()
+    batch = get_dummy_batch(config, args.source_length, args.target_length, args.batch_size, device)
+    T, batch_size = args.target_length, args.batch_size
+    ys = torch.randn(T, batch_size, args.vocabulary_size, device=device, requires_grad=True)
+
+    def fused():
+        get_loss(config, batch, ys).backward()
+
+    def baseline():
+        get_loss_baseline(baseline_loss_fn, batch, ys).backward()
+
+    loss = get_loss(config, batch, ys).item()
+    baseline_loss = get_loss_baseline(baseline_loss_fn, batch, ys).item()
+    print(f'Loss (T={T}, batch={batch_size}, vocabulary={args.vocabulary_size})')
+    print(f'  step-wise baseline: {timeit(baseline, device, args.repeat) * 1000:.2f} ms, loss {baseline_loss:.6f}')
+    print(f'  fused: {timeit(fused, device, args.repeat) * 1000:.2f} ms, loss {loss:.6f}')
+    print(f'  absolute difference: {abs(loss - baseline_loss):.2e}')
+
+
+def get_dataset_model(args, device, source_language, target_language):
+    """Model for the vocabularies of a dataset, with the weights of --weights if given."""
+    config = get_dummy_config(args.hidden_size, args.num_layers, args.window_size, input_feeding=args.input_feeding)
+    config['source_vocabulary_size'] = len(source_language.itos)
+    config['target_vocabulary_size'] = len(target_language.itos)
+    config['EOS'] = target_language.stoi['<eos>']
+    config['PAD_src'] = source_language.stoi['<pad>']
+    config['PAD_trg'] = target_language.stoi['<pad>']
+    config['SOS'] = target_language.stoi['<sos>']
+    if args.no_attention:
+        model = ModelWithoutAttention(config, device)
+    else:
+        model = Model(config, device)
+    if args.weights is not None:
+        model.load_state_dict(torch.load(args.weights, map_location=device))
+    return config, model.to(device)
+
+
+def benchmark_decoding(args, device):
+    _, val_iter, source_language, target_language, _ = load_dataset(args, device)
+    config, model = get_dataset_model(args, device, source_language, target_language)
+    batches = list(val_iter)
+    model.eval()
+
+    def decode(f):
+        def run():
+            with torch.no_grad():
+                for batch in batches:
+                    f(batch)
+        return run
+
+    def reference_length(batch):
+        model(batch, training=False)
+
+    def early_exit(batch):
+        greedy_search(model, batch, args.max_length_ratio)
+
+    def beam(batch):
+        beam_search(model, batch, args.beam_width, args.max_length_ratio, 0)
+
+    decoders = [
+        ('greedy (reference length)', reference_length),
+        ('greedy (early exit)', early_exit),
+        (f'beam search (width {args.beam_width})', beam),
+    ]
+    print(f'Decoding ({args.dataset} validation set, {len(batches)} batches, weights {args.weights})')
+    for name, f in decoders:
+        seconds = timeit(decode(f), device, 1) / len(batches)
+        print(f'  {name}: {seconds * 1000:.2f} ms/batch')
+
+
+def count_allocations(f):
+    """Number of operator calls that allocated memory while running f."""
+    with torch.autograd.profiler.profile(profile_memory=True) as profile:
+        f()
+    allocations = 0
+    for event in profile.function_events:
+        device_memory_usage = getattr(event, 'device_memory_usage', getattr(event, 'cuda_memory_usage', 0))
+        if event.cpu_memory_usage > 0 or device_memory_usage > 0:
+            allocations += 1
+    return allocations
+
+
+def benchmark_decoder_step(args, device):
+    config, model = get_dummy_model(args, device)
+    batch = get_dummy_batch(config, args.source_length, args.target_length, args.batch_size, device)
+    model.eval()
+    with torch.no_grad():
+        initial_state = model.encode(batch)
+    input = torch.full((1, args.batch_size), config.get('SOS'), device=device, dtype=torch.long)
+
+    def decode():
+        with torch.no_grad():
+            state = initial_state
+            for _ in range(args.target_length):
+                _, state = model.step(input, state)
+
+    seconds = timeit(decode, device, args.repeat) / args.target_length
+    allocations = count_allocations(decode) / args.target_length
+    print(f'Decoder step (S={args.source_length}, batch={args.batch_size}, hidden={args.hidden_size})')
+    print(f'  step: {seconds * 1000:.3f} ms')
+    print(f'  allocating operator calls per step: {allocations:.1f}')
+
+
+def benchmark_encoder(args, device):
+    config, model = get_dummy_model(args, device)
+    batch = get_dummy_batch(config, args.source_length, args.target_length, args.batch_size, device)
+    _, source_lengths = batch.src
+    padding = 1 - source_lengths.sum().item() / (args.source_length * args.batch_size)
+    model.train()
+
+    def step():
+        model.zero_grad()
+        encoded = model.encode(batch)
+        hidden = encoded[1]
+        hidden[0].sum().backward()
+
+    seconds = timeit(step, device, args.repeat)
+    print(f'Encoder (S={args.source_length}, batch={args.batch_size}, padding={padding * 100:.1f}%, packed={args.pack_sequences})')
+    print(f'  forward/backward: {seconds * 1000:.2f} ms')
+
+
+STARTUP_SCRIPT = """
+import time
+start = time.perf_counter()
+import torch
+torch_imported = time.perf_counter()
+import main
+main_imported = time.perf_counter()
+from device import select_device
+from parse import get_config
+use_gpu, device, device_idx = select_device()
+config = get_config(use_gpu, device, device_idx)
+next(iter(config.get('train_iter')))
+first_batch = time.perf_counter()
+print(torch_imported - start, main_imported - start, first_batch - start)
+"""
+
+
+def run_scaling_process(rank, world_size, args, port, results):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    configure_cpu(affinity=args.affinity, local_rank=rank, local_world_size=world_size)
+    device = torch.device('cpu')
+    torch.manual_seed(rank)
+    config, model = get_dummy_model(args, device)
+    batch = get_dummy_batch(config, args.source_length, args.target_length, args.batch_size, device)
+    config['model'] = model
+    config['parallel_model'] = DistributedDataParallel(model)
+    config['loss_fn'] = nn.CrossEntropyLoss(reduction='none')
+    config['optimizer'] = torch.optim.Adam(model.parameters(), lr=1e-4)
+    config['precision'] = 'fp32'
+    config['gradient_clipping'] = True
+    seconds = timeit(lambda: train_batch(config, [batch]), device, args.repeat)
+    if rank == 0:
+        results.put(seconds)
+    dist.destroy_process_group()
+
+
+def benchmark_scaling(args, device):
+    """Data parallel training steps on the cpu cores, every process trains on its own batch."""
+    print(f'Data parallel scaling (batch={args.batch_size} per process, {os.cpu_count()} cpus)')
+    results = mp.get_context('spawn').SimpleQueue()
+    baseline = None
+    for world_size in map(int, args.processes.split(',')):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        mp.spawn(run_scaling_process, args=(world_size, args, port, results), nprocs=world_size)
+        seconds = results.get()
+        throughput = world_size * args.batch_size / seconds
+        baseline = baseline or throughput
+        print(f'  {world_size} processes: {seconds * 1000:.2f} ms/step, {throughput:.0f} sentences/sec, '
+              f'speedup {throughput / baseline:.2f}, efficiency {throughput / baseline / world_size:.2f}')
+
+
+def benchmark_startup(args, device):
+    """Times fresh interpreters importing main and loading the first training batch."""
+    command = [sys.executable, '-c', STARTUP_SCRIPT, '--config', args.config]
+    if args.dataset != 'multi30k':
+        command.append(f'--{args.dataset}')
+    times = []
+    for _ in range(args.repeat):
+        output = subprocess.check_output(command, cwd=os.path.dirname(os.path.realpath(__file__)))
+        times.append([float(x) for x in output.decode('utf-8').split('\n')[-2].split()])
+    torch_import, main_import, first_batch = [sum(column) / len(times) for column in zip(*times)]
+    print(f'Startup ({args.config}, {args.dataset})')
+    print(f'  import torch: {torch_import * 1000:.0f} ms')
+    print(f'  import main: {main_import * 1000:.0f} ms')
+    print(f'  first batch: {first_batch * 1000:.0f} ms')
+
+
+def load_dataset(args, device):
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+    config['EOS_token'] = '<eos>'
+    config['PAD_token'] = '<pad>'
+    config['SOS_token'] = '<sos>'
+    return DATASETS[args.dataset](config, device)
+
+
+def benchmark_detokenization(args, device):
+    _, val_iter, _, language, _ = load_dataset(args, device)
+    SOS, EOS, PAD = (language.stoi[token] for token in ['<sos>', '<eos>', '<pad>'])
+    batches = [batch.trg[0] for batch in val_iter]
+    # translations as returned by decode, ending with <eos>
+    translations = [
+        [sentence[1:sentence.index(EOS) + 1] for sentence in with_cpu(batch).t().tolist()]
+        for batch in batches
+    ]
+    n_sentences = sum(map(len, translations))
+
+    def per_sentence():
+        corpus = []
+        for batch, batch_translations in zip(batches, translations):
+            for i in range(batch.size(1)):
+                corpus.append(list(filter_words(torch2words(language, batch[:, i]), '<sos>', '<eos>', '<pad>')))
+            for translation in batch_translations:
+                corpus.append(list(filter_words(list2words(language, translation), '<sos>', '<eos>', '<pad>')))
+        return corpus
+
+    def batched():
+        corpus = []
+        for batch, batch_translations in zip(batches, translations):
+            corpus.extend(batch2words(language, with_cpu(batch).t().numpy(), SOS, EOS, PAD))
+            corpus.extend(batch2words(language, pad_sentences(batch_translations, PAD), SOS, EOS, PAD))
+        return corpus
+
+    print(f'Detokenization ({args.dataset} validation set, {n_sentences} sentences)')
+    print(f'  per sentence: {timeit(per_sentence, device, args.repeat) * 1000:.1f} ms')
+    print(f'  batched: {timeit(batched, device, args.repeat) * 1000:.1f} ms')
+    print(f'  identical: {per_sentence() == batched()}')
+
+
+def benchmark_bleu(args, device):
+    _, val_iter, _, language, _ = load_dataset(args, device)
+    SOS, EOS, PAD = (language.stoi[token] for token in ['<sos>', '<eos>', '<pad>'])
+    batches = [batch2ids(with_cpu(batch.trg[0]).t().numpy(), SOS, EOS, PAD) for batch in val_iter]
+    # perturbed references stand in for translations
+    random = np.random.RandomState(0)
+    translations = [
+        [[word if random.rand() > 0.2 else random.randint(len(language.itos)) for word in sentence] for sentence in batch]
+        for batch in batches
+    ]
+    reference_corpus = [[sentence] for batch in batches for sentence in batch]
+    translation_corpus = [sentence for batch in translations for sentence in batch]
+    workers = int(args.workers.split(',')[-1])
+
+    def accumulate():
+        bleu = BleuAccumulator()
+        for references, batch_translations in zip(batches, translations):
+            bleu.add([[sentence] for sentence in references], batch_translations)
+        return bleu.score()
+
+    bleu = compute_bleu(reference_corpus, translation_corpus)
+    print(f'BLEU ({args.dataset} validation set, {len(translation_corpus)} sentences)')
+    print(f'  compute_bleu: {timeit(lambda: compute_bleu(reference_corpus, translation_corpus), device, args.repeat) * 1000:.1f} ms')
+    print(f'  statistics: {timeit(lambda: get_corpus_statistics(reference_corpus, translation_corpus), device, args.repeat) * 1000:.1f} ms')
+    seconds = timeit(lambda: get_corpus_statistics(reference_corpus, translation_corpus, workers=workers), device, args.repeat)
+    print(f'  statistics ({workers} workers): {seconds * 1000:.1f} ms')
+    print(f'  accumulated per batch: {timeit(accumulate, device, args.repeat) * 1000:.1f} ms')
+    print(f'  BLEU: {bleu:.2f}')
+
+
+def run_threads_process(args, threads, interop_threads, results):
+    configure_cpu(threads, interop_threads, args.affinity)
+    device = torch.device('cpu')
+    _, val_iter, source_language, target_language, _ = load_dataset(args, device)
+    _, model = get_dataset_model(args, device, source_language, target_language)
+    model.eval()
+    batches = list(val_iter)
+    n_sentences = sum(batch.src[1].size(0) for batch in batches)
+
+    def forward():
+        with torch.no_grad():
+            for batch in batches:
+                model(batch)
+
+    seconds = timeit(forward, device, args.repeat)
+    results.put(n_sentences / seconds)
+
+
+def benchmark_threads(args, device):
+    """Model forward passes on the validation batches of a dataset for combinations of thread counts.
+
+    Every combination runs in a fresh process, as inter-op threads can only be set once.
+    """
+    print(f'Threads ({args.dataset}, {len(get_available_cpus())} cpus, affinity {args.affinity})')
+    context = mp.get_context('spawn')
+    results = context.SimpleQueue()
+    best = None
+    for interop_threads in map(int, args.interop_threads.split(',')):
+        for threads in map(int, args.threads.split(',')):
+            process = context.Process(target=run_threads_process, args=(args, threads, interop_threads, results))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                raise Exception(f'Benchmark process failed with exit code {process.exitcode}')
+            throughput = results.get()
+            print(f'  {threads} threads, {interop_threads} inter-op threads: {throughput:.0f} sentences/sec')
+            if best is None or throughput > best[0]:
+                best = (throughput, threads, interop_threads)
+    profile = {'cpu': {'threads': best[1], 'interop_threads': best[2], 'affinity': args.affinity}}
+    print(f'Best: {json.dumps(profile)}')
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(profile, f, indent=2)
+
+
+def benchmark_tokenization(args, device):
+    if args.tokenizer == 'dummy':
+        tokenizers = (tokenize_dummy_batch, tokenize_dummy_batch)
+    else:
+        tokenizers = (tokenize_de_batch, tokenize_en_batch)
+    print(f'Tokenization ({args.input}, chunk size {args.chunk_size})')
+    for workers in map(int, args.workers.split(',')):
+        start = time.perf_counter()
+        n_sentences = 0
+        for sources, _ in tokenize_csv(args.input, *tokenizers, workers, args.chunk_size):
+            n_sentences += len(sources)
+        seconds = time.perf_counter() - start
+        print(f'  {workers} workers: {n_sentences / seconds:.0f} sentences/sec ({seconds:.2f}s)')
+
+
+def benchmark_vocabulary(args, device):
+    legacy_path = f'{args.model_data_path}/language.json'
+    with tempfile.TemporaryDirectory() as path:
+        shutil.copy(legacy_path, path)
+        legacy_seconds = timeit(lambda: load_vocabularies(path), device, args.repeat)
+        source_vocabulary, target_vocabulary = load_vocabularies(path)
+        save_vocabularies(path, source_vocabulary, target_vocabulary)
+        seconds = timeit(lambda: load_vocabularies(path), device, args.repeat)
+        loaded = load_vocabularies(path)
+        with open(legacy_path, 'r') as f:
+            legacy = json.load(f)
+        same = all(vocabulary.stoi == legacy.get(side).get('stoi') for vocabulary, side in zip(loaded, ['source', 'target']))
+        size = os.path.getsize(f'{path}/vocabulary.json')
+    print(f'Vocabulary ({args.model_data_path}, identical after conversion: {same})')
+    print(f'  language.json: {os.path.getsize(legacy_path) / 2 ** 10:.0f} KiB, {legacy_seconds * 1000:.1f} ms')
+    print(f'  vocabulary.json: {size / 2 ** 10:.0f} KiB, {seconds * 1000:.1f} ms')
+
+
+DATASETS = {
+    'debug': load_debug,
+    'dummy_fixed_length': load_dummy_fixed_length,
+    'dummy_variable_length': load_dummy_variable_length,
+    'iwslt': load_iwslt,
+    'multi30k': load_multi30k,
+}
+
+BENCHMARKS = {
+    'attention': benchmark_attention,
+    'bleu': benchmark_bleu,
+    'decoder_step': benchmark_decoder_step,
+    'decoding': benchmark_decoding,
+    'detokenization': benchmark_detokenization,
+    'encoder': benchmark_encoder,
+    'logging': benchmark_logging,
+    'loss': benchmark_loss,
+    'precision': benchmark_precision,
+    'scaling': benchmark_scaling,
+    'startup': benchmark_startup,
+    'threads': benchmark_threads,
+    'tokenization': benchmark_tokenization,
+    'training': benchmark_training,
+    'vocabulary': benchmark_vocabulary,
+}
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark machine translation model components.')
+    parser.add_argument('benchmark', type=str, choices=sorted(BENCHMARKS.keys()), help='Benchmark to run.')
+    parser.add_argument('--affinity', action='store_true', help='Pin the benchmark processes to their cores.')
+    parser.add_argument('--batch_size', type=int, default=64, help='Sentences per batch.')
+    parser.add_argument('--beam_width', type=int, default=5, help='Beam width.')
+    parser.add_argument('--chunk_size', type=int, default=10000, help='Sentences tokenized per chunk.')
+    parser.add_argument('--config', type=str, default='configs/dummy.json', help='Configuration of the dataset.')
+    parser.add_argument('--dataset', type=str, default='dummy_variable_length', choices=sorted(DATASETS.keys()), help='Dataset.')
+    parser.add_argument('--hidden_size', type=int, default=256, help='Hidden size of the model.')
+    parser.add_argument('--input', type=str, default='.data/iwslt/train.csv', help='Csv file to tokenize.')
+    parser.add_argument('--input_feeding', action='store_true', help='Use input feeding.')
+    parser.add_argument('--interop_threads', type=str, default='1,2', help='Comma separated numbers of inter-op threads.')
+    parser.add_argument('--max_length_ratio', type=float, default=2, help='Maximum translation length relative to the source.')
+    parser.add_argument('--model_data_path', type=str, default='model-data/final', help='Directory with a saved vocabulary.')
+    parser.add_argument('--no_attention', action='store_true', help='Use the model without attention.')
+    parser.add_argument('--num_layers', type=int, default=2, help='Number of LSTM layers.')
+    parser.add_argument('--output', type=str, default=None, help='File the best cpu settings are written to.')
+    parser.add_argument('--pack_sequences', action='store_true', help='Do not run padding through the encoder.')
+    parser.add_argument('--precisions', type=str, default='fp32,bf16', help='Comma separated precisions to compare.')
+    parser.add_argument('--processes', type=str, default='1,2,4', help='Comma separated numbers of training processes.')
+    parser.add_argument('--repeat', type=int, default=10, help='Number of timed repetitions.')
+    parser.add_argument('--source_length', type=int, default=30, help='Maximum source sentence length.')
+    parser.add_argument('--target_length', type=int, default=30, help='Maximum target sentence length.')
+    parser.add_argument('--teacher_forcing', type=float, default=1, help='Teacher forcing ratio.')
+    parser.add_argument('--threads', type=str, default='1,2,4,8', help='Comma separated numbers of intra-op threads.')
+    parser.add_argument('--tokenizer', type=str, default='spacy', choices=['dummy', 'spacy'], help='Tokenizers to benchmark.')
+    parser.add_argument('--vocabulary_size', type=int, default=20000, help='Target vocabulary size.')
+    parser.add_argument('--weights', type=str, default=None, help='Trained model weights for the dataset benchmarks.')
+    parser.add_argument('--window_size', type=int, default=7, help='Local attention window size.')
+    parser.add_argument('--workers', type=str, default='1,2,4,8', help='Comma separated numbers of workers.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    _, device, _ = select_device()
+    BENCHMARKS[args.benchmark](args, device)
+
+
+if __name__ == '__main__':
+    main()
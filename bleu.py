@@ -1,92 +1,220 @@
-
-# Reference: https://github.com/tensorflow/nmt/blob/master/nmt/scripts/bleu.py
-
-"""Python implementation of BLEU and smooth-BLEU.
-This module provides a Python implementation of BLEU and smooth-BLEU.
-"""
-
-import collections
-import math
-
-
-def _get_ngrams(segment, max_order):
-    """Extracts all n-grams upto a given maximum order from an input segment.
-    Args:
-        segment: text segment from which n-grams will be extracted.
-        max_order: maximum length in tokens of the n-grams returned by this method.
-    Returns:
-        The Counter containing all n-grams upto max_order in segment
-        with a count of how many times each n-gram occurred
-    """
-    ngram_counts = collections.Counter()
-    for order in range(1, max_order + 1):
-        for i in range(0, len(segment) - order + 1):
-            ngram = tuple(segment[i:i+order])
-            ngram_counts[ngram] += 1
-    return ngram_counts
-
-
-def compute_bleu(reference_corpus, translation_corpus, max_order=4, smooth=False):
-    """Computes BLEU score of translated segments against one or more references.
-        Args:
-            reference_corpus: list of lists of references for each translation. Each
-            reference should be tokenized into a list of tokens.
-            translation_corpus: list of translations to score. Each translation
-            should be tokenized into a list of tokens.
-            max_order: Maximum n-gram order to use when computing BLEU score.
-            smooth: Whether or not to apply Lin et al. 2004 smoothing.
-        Returns:
-            3-Tuple with the BLEU score, n-gram precisions, geometric mean of n-gram
-            precisions and brevity penalty.
-    """
-    matches_by_order = [0] * max_order
-    possible_matches_by_order = [0] * max_order
-    reference_length = 0
-    translation_length = 0
-    for (references, translation) in zip(reference_corpus, translation_corpus):
-        reference_length += min(len(r) for r in references)
-        translation_length += len(translation)
-
-        merged_ref_ngram_counts = collections.Counter()
-        for reference in references:
-            merged_ref_ngram_counts |= _get_ngrams(reference, max_order)
-        translation_ngram_counts = _get_ngrams(translation, max_order)
-        overlap = translation_ngram_counts & merged_ref_ngram_counts
-        for ngram in overlap:
-            matches_by_order[len(ngram)-1] += overlap[ngram]
-        for order in range(1, max_order+1):
-            possible_matches = len(translation) - order + 1
-            if possible_matches > 0:
-                possible_matches_by_order[order-1] += possible_matches
-
-    precisions = [0] * max_order
-    for i in range(0, max_order):
-        if smooth:
-            precisions[i] = ((matches_by_order[i] + 1.) / (possible_matches_by_order[i] + 1.))
-        else:
-            if possible_matches_by_order[i] > 0:
-                precisions[i] = (float(matches_by_order[i]) / possible_matches_by_order[i])
-            else:
-                precisions[i] = 0.0
-
-    if min(precisions) > 0:
-        p_log_sum = sum((1. / max_order) * math.log(p) for p in precisions)
-        geo_mean = math.exp(p_log_sum)
-    else:
-        geo_mean = 0
-
-    # bleu score of 0 if translations only contain the empty string
-    if translation_length == 0:
-        return 0.
-
-    ratio = float(translation_length) / reference_length
-
-    if ratio > 1.0:
-        bp = 1.
-    else:
-        bp = math.exp(1 - 1. / ratio)
-
-    bleu = 100 * geo_mean * bp
-
-    # return (bleu, precisions, bp, ratio, translation_length, reference_length)
-    return bleu
+
+# Reference: https://github.com/tensorflow/nmt/blob/master/nmt/scripts/bleu.py
+
+"""Python implementation of BLEU and smooth-BLEU.
+This module provides a Python implementation of BLEU and smooth-BLEU.
+"""
+
+import collections
+import itertools
+import math
+import multiprocessing
+import numpy as np
+
+
+def _get_ngrams(segment, max_order):
+    """Extracts all n-grams upto a given maximum order from an input segment.
+    Args:
+        segment: text segment from which n-grams will be extracted.
+        max_order: maximum length in tokens of the n-grams returned by this method.
+    Returns:
+        The Counter containing all n-grams upto max_order in segment
+        with a count of how many times each n-gram occurred
+    """
+    ngram_counts = collections.Counter()
+    for order in range(1, max_order + 1):
+        for i in range(0, len(segment) - order + 1):
+            ngram = tuple(segment[i:i+order])
+            ngram_counts[ngram] += 1
+    return ngram_counts
+
+
+def compute_bleu(reference_corpus, translation_corpus, max_order=4, smooth=False):
+    """Computes BLEU score of translated segments against one or more references.
+        Args:
+            reference_corpus: list of lists of references for each translation. Each
+            reference should be tokenized into a list of tokens.
+            translation_corpus: list of translations to score. Each translation
+            should be tokenized into a list of tokens.
+            max_order: Maximum n-gram order to use when computing BLEU score.
+            smooth: Whether or not to apply Lin et al. 2004 smoothing.
+        Returns:
+            3-Tuple with the BLEU score, n-gram precisions, geometric mean of n-gram
+            precisions and brevity penalty.
+    """
+    matches_by_order = [0] * max_order
+    possible_matches_by_order = [0] * max_order
+    reference_length = 0
+    translation_length = 0
+    for (references, translation) in zip(reference_corpus, translation_corpus):
+        reference_length += min(len(r) for r in references)
+        translation_length += len(translation)
+
+        merged_ref_ngram_counts = collections.Counter()
+        for reference in references:
+            merged_ref_ngram_counts |= _get_ngrams(reference, max_order)
+        translation_ngram_counts = _get_ngrams(translation, max_order)
+        overlap = translation_ngram_counts & merged_ref_ngram_counts
+        for ngram in overlap:
+            matches_by_order[len(ngram)-1] += overlap[ngram]
+        for order in range(1, max_order+1):
+            possible_matches = len(translation) - order + 1
+            if possible_matches > 0:
+                possible_matches_by_order[order-1] += possible_matches
+
+    statistics = matches_by_order + possible_matches_by_order + [reference_length, translation_length]
+    return compute_bleu_from_statistics(statistics, max_order, smooth)
+
+
+def _pad(sentences):
+    lengths = np.array([len(sentence) for sentence in sentences], dtype=np.int64)
+    batch = np.zeros((len(sentences), max(lengths.max(initial=0), 1)), dtype=np.int64)
+    for i, sentence in enumerate(sentences):
+        batch[i, :len(sentence)] = sentence
+    return batch, lengths
+
+
+def _max_by_key(keys, values):
+    """Sorted unique keys and the maximum of the values of every key."""
+    if len(keys) == 0:
+        return keys, values
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    values = values[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return keys[starts], np.maximum.reduceat(values, starts)
+
+
+def _lookup(keys, values, queries):
+    """Values of the queries in sorted keys, 0 for queries that are missing."""
+    if len(keys) == 0:
+        return np.zeros(len(queries), dtype=values.dtype)
+    positions = np.minimum(np.searchsorted(keys, queries), len(keys) - 1)
+    return np.where(keys[positions] == queries, values[positions], 0)
+
+
+def get_statistics(reference_corpus, translation_corpus, max_order=4):
+    """Computes the BLEU statistics of every translation from token indices.
+
+    The n-grams of all sentences are hashed into integers one order at a time:
+    the key of an n-gram is the rank of its (n-1)-gram prefix times the largest
+    token index plus one, plus its last token index. Keys are collision free and
+    do not overflow. Statistics of different sentences can be summed, so they
+    can be computed in chunks, in worker processes or batch by batch.
+        Args:
+            reference_corpus: list of lists of references for each translation. Each
+            reference should be a list of token indices.
+            translation_corpus: list of translations to score. Each translation
+            should be a list of token indices.
+            max_order: Maximum n-gram order to use when computing BLEU score.
+        Returns:
+            Integer array with a row for every translation holding the matches by order,
+            the possible matches by order, the reference length and the translation length.
+    """
+    n = len(translation_corpus)
+    statistics = np.zeros((n, 2 * max_order + 2), dtype=np.int64)
+    if n == 0:
+        return statistics
+    references = [reference for references in reference_corpus for reference in references]
+    owners = np.array([i for i, references in enumerate(reference_corpus) for _ in references], dtype=np.int64)
+    # translations are the first n rows of the batch and references the others
+    batch, lengths = _pad(list(translation_corpus) + references)
+    translation_lengths = lengths[:n]
+    reference_lengths = np.full(n, np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(reference_lengths, owners, lengths[n:])
+    statistics[:, 2 * max_order] = reference_lengths
+    statistics[:, 2 * max_order + 1] = translation_lengths
+
+    base = batch.max() + 1
+    keys = np.zeros(batch.shape, dtype=np.int64)
+    for order in range(1, max_order + 1):
+        statistics[:, max_order + order - 1] = np.maximum(translation_lengths - order + 1, 0)
+        width = batch.shape[1] - order + 1
+        if width <= 0:
+            break
+        _, prefixes = np.unique(keys[:, :width], return_inverse=True)
+        keys = prefixes.reshape(-1, width) * base + batch[:, order-1:]
+
+        valid = np.arange(width) < (lengths - order + 1)[:, None]
+        rows = np.broadcast_to(np.arange(len(batch))[:, None], keys.shape)[valid]
+        ngrams, ranks = np.unique(keys[valid], return_inverse=True)
+        # (sentence, n-gram) pairs as one integer
+        pairs = rows * len(ngrams) + ranks.reshape(-1)
+        is_translation = rows < n
+        translation_pairs, translation_counts = np.unique(pairs[is_translation], return_counts=True)
+        reference_pairs, reference_counts = np.unique(pairs[~is_translation], return_counts=True)
+        # clip by the maximum count in any of the references of a translation
+        reference_pairs = owners[reference_pairs // len(ngrams) - n] * len(ngrams) + reference_pairs % len(ngrams)
+        reference_pairs, reference_counts = _max_by_key(reference_pairs, reference_counts)
+        matches = np.minimum(translation_counts, _lookup(reference_pairs, reference_counts, translation_pairs))
+        np.add.at(statistics[:, order - 1], translation_pairs // len(ngrams), matches)
+    return statistics
+
+
+def get_corpus_statistics(reference_corpus, translation_corpus, max_order=4, workers=1, chunk_size=1000):
+    """Sums the BLEU statistics of a corpus, computing chunks of it in worker processes."""
+    chunks = [
+        (reference_corpus[i:i+chunk_size], translation_corpus[i:i+chunk_size], max_order)
+        for i in range(0, len(translation_corpus), chunk_size)
+    ]
+    statistics = np.zeros(2 * max_order + 2, dtype=np.int64)
+    if workers <= 1:
+        results = itertools.starmap(get_statistics, chunks)
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.starmap(get_statistics, chunks)
+    for chunk_statistics in results:
+        statistics += chunk_statistics.sum(0)
+    return statistics
+
+
+def compute_bleu_from_statistics(statistics, max_order=4, smooth=False):
+    """Computes BLEU score from the statistics of compute_bleu, get_corpus_statistics or summed get_statistics."""
+    statistics = [int(x) for x in statistics]
+    matches_by_order = statistics[:max_order]
+    possible_matches_by_order = statistics[max_order:2 * max_order]
+    reference_length, translation_length = statistics[2 * max_order:]
+
+    precisions = [0] * max_order
+    for i in range(0, max_order):
+        if smooth:
+            precisions[i] = ((matches_by_order[i] + 1.) / (possible_matches_by_order[i] + 1.))
+        else:
+            if possible_matches_by_order[i] > 0:
+                precisions[i] = (float(matches_by_order[i]) / possible_matches_by_order[i])
+            else:
+                precisions[i] = 0.0
+
+    if min(precisions) > 0:
+        p_log_sum = sum((1. / max_order) * math.log(p) for p in precisions)
+        geo_mean = math.exp(p_log_sum)
+    else:
+        geo_mean = 0
+
+    # bleu score of 0 if translations only contain the empty string
+    if translation_length == 0:
+        return 0.
+
+    ratio = float(translation_length) / reference_length
+
+    if ratio > 1.0:
+        bp = 1.
+    else:
+        bp = math.exp(1 - 1. / ratio)
+
+    return 100 * geo_mean * bp
+
+
+class BleuAccumulator:
+    """Accumulates BLEU statistics batch by batch so evaluation can stream."""
+
+    def __init__(self, max_order=4, smooth=False):
+        self.max_order = max_order
+        self.smooth = smooth
+        self.statistics = np.zeros(2 * max_order + 2, dtype=np.int64)
+
+    def add(self, reference_corpus, translation_corpus):
+        self.statistics += get_statistics(reference_corpus, translation_corpus, self.max_order).sum(0)
+
+    def score(self):
+        return compute_bleu_from_statistics(self.statistics, self.max_order, self.smooth)
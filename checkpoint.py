@@ -0,0 +1,131 @@
+import numpy as np
+import os
+import random
+import re
+import threading
+import torch
+
+
+CHECKPOINT_PATTERN = re.compile(r'^checkpoint-(\d+)$')
+
+
+def to_cpu_copy(value):
+    """Copies the tensors of a (nested) state dict to the cpu, so training can go on changing the originals."""
+    if torch.is_tensor(value):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, dict):
+        return {key: to_cpu_copy(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(to_cpu_copy(item) for item in value)
+    return value
+
+
+def get_rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def list_checkpoints(path):
+    """Checkpoint files in path, oldest first."""
+    if not os.path.exists(path):
+        return []
+    steps = []
+    for name in os.listdir(path):
+        match = CHECKPOINT_PATTERN.match(name)
+        if match is not None:
+            steps.append(int(match.group(1)))
+    return [os.path.join(path, f'checkpoint-{step}') for step in sorted(steps)]
+
+
+def load_latest_checkpoint(path, device):
+    """State of the newest checkpoint in path, None if there is none."""
+    checkpoints = list_checkpoints(path)
+    if len(checkpoints) == 0:
+        return None
+    return torch.load(checkpoints[-1], map_location=device, weights_only=False)
+
+
+def save_atomic(state, path):
+    """Writes to a temporary file that is renamed, so path never holds a partial checkpoint.
+
+    The file is synced before the rename and the directory after it, so a
+    crash of the machine leaves either the old or the complete new file.
+    """
+    temporary_path = f'{path}.tmp'
+    with open(temporary_path, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, path)
+    if hasattr(os, 'O_DIRECTORY'):
+        directory = os.open(os.path.dirname(path) or '.', os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+
+class CheckpointWriter:
+    """Writes checkpoints from a background thread and keeps the newest ones.
+
+    save copies the state to the cpu and returns, the background thread
+    serializes it. When the thread is still writing, the next state waits and
+    a newer state replaces it, so at most one copy is held in memory.
+    """
+
+    def __init__(self, path, keep=3):
+        self.path = path
+        self.keep = keep
+        os.makedirs(path, exist_ok=True)
+        self.pending = None
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def save(self, state, step):
+        state = to_cpu_copy(state)
+        with self.condition:
+            self.pending = (state, step)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.closed:
+                    self.condition.wait()
+                if self.pending is None:
+                    break
+                state, step = self.pending
+                self.pending = None
+            try:
+                self.write(state, step)
+            except Exception as exception:
+                # a failed checkpoint should not stop training, the previous ones are still there
+                print(f'Checkpoint: could not write step {step}: {exception}')
+
+    def write(self, state, step):
+        save_atomic(state, os.path.join(self.path, f'checkpoint-{step}'))
+        for path in list_checkpoints(self.path)[:-self.keep]:
+            os.remove(path)
+
+    def close(self):
+        """Writes the waiting checkpoint and stops the background thread."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
@@ -1,71 +1,96 @@
+from dataset import load_cached
+from functools import lru_cache
 import os
-import spacy
-import torchtext
 from utils import (
     create_debug_csv,
     create_multi30k,
     create_iwslt,
     create_dummy_fixed_length_csv,
     create_dummy_variable_length_csv,
+    download_and_extract,
     get_or_create_dir,
-    load_from_csv
+    strip_iwslt_tags,
 )
 
 
-# load tokenizers for german and english
-spacy_de = spacy.load('de')
-spacy_en = spacy.load('en')
+PIPE_BATCH_SIZE = 1000
+SPACY_MODELS = {'de': 'de_core_news_sm', 'en': 'en_core_web_sm'}
+# the archives torchtext's IWSLT and Multi30k datasets downloaded
+IWSLT_URL = 'https://wit3.fbk.eu/archive/2016-01//texts/de/en/de-en.tgz'
+MULTI30K_URLS = [
+    'http://www.quest.dcs.shef.ac.uk/wmt16_files_mmt/training.tar.gz',
+    'http://www.quest.dcs.shef.ac.uk/wmt16_files_mmt/validation.tar.gz',
+    'http://www.quest.dcs.shef.ac.uk/wmt17_files_mmt/mmt_task1_test2016.tar.gz',
+]
+
+
+@lru_cache(maxsize=None)
+def get_spacy(language):
+    """Loads the spaCy model of a language on first use, loading it takes seconds."""
+    import spacy
+    return spacy.load(SPACY_MODELS[language])
 
 
 def tokenize_de(text):
-    return [token.text for token in spacy_de.tokenizer(text)]
+    return [token.text for token in get_spacy('de').tokenizer(text)]
 
 
 def tokenize_en(text):
-    return [token.text for token in spacy_en.tokenizer(text)]
+    return [token.text for token in get_spacy('en').tokenizer(text)]
 
 
 def tokenize_dummy(text):
     return text.split(' ')
 
 
+def tokenize_de_batch(texts):
+    return [[token.text for token in doc] for doc in get_spacy('de').tokenizer.pipe(texts, batch_size=PIPE_BATCH_SIZE)]
+
+
+def tokenize_en_batch(texts):
+    return [[token.text for token in doc] for doc in get_spacy('en').tokenizer.pipe(texts, batch_size=PIPE_BATCH_SIZE)]
+
+
+def tokenize_dummy_batch(texts):
+    return [tokenize_dummy(text) for text in texts]
+
+
 def load_debug(config, device):
     csv_dir_path = get_or_create_dir('.data', 'debug')
     if not os.path.exists(f'{csv_dir_path}/train.csv'):
         create_debug_csv()
-    return load_from_csv(config, csv_dir_path, tokenize_de, tokenize_en, device)
+    return load_cached(config, csv_dir_path, tokenize_de_batch, tokenize_en_batch, device)
 
 
 def load_dummy_fixed_length(config, device):
     csv_dir_path = get_or_create_dir('.data', 'dummy_fixed_length')
     if not os.path.exists(f'{csv_dir_path}/train.csv'):
         create_dummy_fixed_length_csv()
-    return load_from_csv(config, csv_dir_path, tokenize_dummy, tokenize_dummy, device)
+    return load_cached(config, csv_dir_path, tokenize_dummy_batch, tokenize_dummy_batch, device)
 
 
 def load_dummy_variable_length(config, device):
     csv_dir_path = get_or_create_dir('.data', 'dummy_variable_length')
     if not os.path.exists(f'{csv_dir_path}/train.csv'):
         create_dummy_variable_length_csv()
-    return load_from_csv(config, csv_dir_path, tokenize_dummy, tokenize_dummy, device)
+    return load_cached(config, csv_dir_path, tokenize_dummy_batch, tokenize_dummy_batch, device)
 
 
 def load_iwslt(config, device):
     csv_dir_path = get_or_create_dir('.data', 'iwslt')
     if not os.path.exists(f'{csv_dir_path}/train.csv'):
         if not os.path.exists(f'{csv_dir_path}/de-en'):
-            source_field = torchtext.data.Field(tokenize=tokenize_de)
-            target_field = torchtext.data.Field(tokenize=tokenize_en)
-            torchtext.datasets.IWSLT.splits(exts=('.de', '.en'), fields=(source_field, target_field))
+            download_and_extract(IWSLT_URL, csv_dir_path)
+            for language in ['de', 'en']:
+                strip_iwslt_tags(f'{csv_dir_path}/de-en/train.tags.de-en.{language}', f'{csv_dir_path}/de-en/train.de-en.{language}')
         create_iwslt()
-    return load_from_csv(config, csv_dir_path, tokenize_de, tokenize_en, device)
+    return load_cached(config, csv_dir_path, tokenize_de_batch, tokenize_en_batch, device)
 
 
 def load_multi30k(config, device):
     csv_dir_path = get_or_create_dir('.data', 'multi30k')
     if not os.path.exists(f'{csv_dir_path}/train.csv'):
-        source_field = torchtext.data.Field(tokenize=tokenize_de)
-        target_field = torchtext.data.Field(tokenize=tokenize_en)
-        torchtext.datasets.Multi30k.splits(exts=('.de', '.en'), fields=(source_field, target_field))
+        for url in MULTI30K_URLS:
+            download_and_extract(url, csv_dir_path)
         create_multi30k()
-    return load_from_csv(config, csv_dir_path, tokenize_de, tokenize_en, device)
+    return load_cached(config, csv_dir_path, tokenize_de_batch, tokenize_en_batch, device)
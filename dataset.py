@@ -0,0 +1,400 @@
+from collections import Counter, deque, namedtuple
+import csv
+from device import configure_cpu
+import hashlib
+import itertools
+import json
+import multiprocessing
+import numpy as np
+import os
+import random
+import shutil
+import torch
+
+
+# bump when the layout of the cache changes
+CACHE_VERSION = 1
+# token indices mapped to the vocabulary at a time
+REMAP_CHUNK_SIZE = 1 << 20
+UNK_token = '<unk>'
+SPLITS = ['train', 'val']
+SIDES = ['src', 'trg']
+
+Batch = namedtuple('Batch', ['src', 'trg'])
+
+
+class Vocabulary:
+
+    def __init__(self, itos):
+        self.itos = itos
+        self.stoi = {word: index for index, word in enumerate(itos)}
+        # for looking up a whole array of indices at once
+        self.words = np.array(itos, dtype=object)
+
+
+def hash_file(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_cache_key(config, csv_dir_path, source_tokenizer, target_tokenizer):
+    key = {
+        'version': CACHE_VERSION,
+        'tokenizers': [source_tokenizer.__name__, target_tokenizer.__name__],
+        'vocabulary_sizes': [config.get('source_vocabulary_size'), config.get('target_vocabulary_size')],
+        'files': {split: hash_file(f'{csv_dir_path}/{split}.csv') for split in SPLITS},
+    }
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+    return digest, key
+
+
+def build_vocabulary(counter, specials, max_size):
+    """Builds the vocabulary the way torchtext does: specials first, then by frequency and alphabetically."""
+    for special in specials:
+        del counter[special]
+    words = sorted(counter.items(), key=lambda item: item[0])
+    words.sort(key=lambda item: item[1], reverse=True)
+    if max_size is not None:
+        words = words[:max_size]
+    return Vocabulary(specials + [word for word, _ in words])
+
+
+def read_csv(path):
+    with open(path, 'r', newline='') as f:
+        reader = csv.reader(f)
+        next(reader)
+        for row in reader:
+            yield row
+
+
+def read_chunks(path, chunk_size):
+    rows = read_csv(path)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if len(chunk) == 0:
+            break
+        yield chunk
+
+
+def tokenize_chunk(source_tokenizer, target_tokenizer, rows):
+    return source_tokenizer([row[0] for row in rows]), target_tokenizer([row[1] for row in rows])
+
+
+def tokenize_csv(path, source_tokenizer, target_tokenizer, workers, chunk_size):
+    """Streams a csv file in chunks and yields the tokenized (sources, targets) of every chunk in order.
+
+    Chunks are tokenized by a pool of worker processes. At most two chunks per
+    worker are read ahead, so memory does not grow with the size of the file.
+    """
+    chunks = read_chunks(path, chunk_size)
+    if workers <= 1:
+        for rows in chunks:
+            yield tokenize_chunk(source_tokenizer, target_tokenizer, rows)
+        return
+    # every worker tokenizes with a single torch thread so the workers do not oversubscribe the cores
+    with multiprocessing.Pool(workers, initializer=configure_cpu, initargs=(1, 1)) as pool:
+        pending = deque()
+        for rows in chunks:
+            pending.append(pool.apply_async(tokenize_chunk, (source_tokenizer, target_tokenizer, rows)))
+            if len(pending) > 2 * workers:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
+
+
+def read_raw(path):
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=np.int32)
+    return np.memmap(path, dtype=np.int32, mode='r')
+
+
+def build_cache(config, csv_dir_path, cache_path, key, source_tokenizer, target_tokenizer):
+    """Tokenizes the csv splits once and writes token indices, offsets and vocabularies to cache_path.
+
+    Tokens are written to disk as they are tokenized, indexed in order of first
+    appearance. Once the vocabulary is known these indices are mapped to the
+    vocabulary indices chunk by chunk.
+    """
+    preprocessing = config.get('preprocessing', {})
+    workers = preprocessing.get('workers', os.cpu_count())
+    chunk_size = preprocessing.get('chunk_size', 10000)
+
+    # write to a temporary directory first so an interrupted build never leaves a partial cache
+    temporary_path = f'{cache_path}.tmp'
+    shutil.rmtree(temporary_path, ignore_errors=True)
+    os.makedirs(temporary_path)
+
+    print(f'Data loader: Tokenizing ({workers} workers).')
+    first_seen = {side: {} for side in SIDES}
+    lengths = {split: {side: [] for side in SIDES} for split in SPLITS}
+    for split in SPLITS:
+        files = {side: open(f'{temporary_path}/{split}.{side}.raw', 'wb') for side in SIDES}
+        try:
+            tokenized = tokenize_csv(f'{csv_dir_path}/{split}.csv', source_tokenizer, target_tokenizer, workers, chunk_size)
+            for chunk in tokenized:
+                for side, sentences in zip(SIDES, chunk):
+                    indices = first_seen[side]
+                    words = [indices.setdefault(word, len(indices)) for sentence in sentences for word in sentence]
+                    np.array(words, dtype=np.int32).tofile(files[side])
+                    lengths[split][side].extend(len(sentence) for sentence in sentences)
+        finally:
+            for f in files.values():
+                f.close()
+
+    print('Data loader: Building vocabulary.')
+    specials = [UNK_token, config.get('PAD_token'), config.get('SOS_token'), config.get('EOS_token')]
+    vocabulary_sizes = {'src': config.get('source_vocabulary_size'), 'trg': config.get('target_vocabulary_size')}
+    vocabularies = {}
+    for side in SIDES:
+        words = list(first_seen[side])
+        counts = np.zeros(len(words), dtype=np.int64)
+        for split in SPLITS:
+            counts += np.bincount(read_raw(f'{temporary_path}/{split}.{side}.raw'), minlength=len(words))
+        counter = Counter(dict(zip(words, counts.tolist())))
+        vocabulary = build_vocabulary(counter, specials, vocabulary_sizes[side])
+        unknown = vocabulary.stoi[UNK_token]
+        mapping = np.array([vocabulary.stoi.get(word, unknown) for word in words], dtype=np.int32)
+        for split in SPLITS:
+            raw_path = f'{temporary_path}/{split}.{side}.raw'
+            raw = read_raw(raw_path)
+            tokens_path = f'{temporary_path}/{split}.{side}.tokens.npy'
+            if len(raw) > 0:
+                tokens = np.lib.format.open_memmap(tokens_path, mode='w+', dtype=np.int32, shape=raw.shape)
+                for start in range(0, len(raw), REMAP_CHUNK_SIZE):
+                    tokens[start:start+REMAP_CHUNK_SIZE] = mapping[raw[start:start+REMAP_CHUNK_SIZE]]
+                tokens.flush()
+                del tokens
+            else:
+                np.save(tokens_path, raw)
+            del raw
+            os.remove(raw_path)
+            offsets = np.zeros(len(lengths[split][side]) + 1, dtype=np.int64)
+            np.cumsum(lengths[split][side], out=offsets[1:])
+            np.save(f'{temporary_path}/{split}.{side}.offsets.npy', offsets)
+        vocabularies[side] = vocabulary
+
+    with open(f'{temporary_path}/vocabulary.json', 'w') as f:
+        json.dump({side: vocabularies[side].itos for side in SIDES}, f)
+    with open(f'{temporary_path}/meta.json', 'w') as f:
+        json.dump(key, f)
+    os.rename(temporary_path, cache_path)
+
+
+class Dataset:
+    """Memory mapped token indices of a split, sentences are read only when a batch is created."""
+
+    def __init__(self, cache_path, split, vocabularies, config):
+        self.tokens = {}
+        self.offsets = {}
+        self.lengths = {}
+        for side in SIDES:
+            self.tokens[side] = np.load(f'{cache_path}/{split}.{side}.tokens.npy', mmap_mode='r')
+            self.offsets[side] = np.load(f'{cache_path}/{split}.{side}.offsets.npy')
+            # lengths include <sos> and <eos>
+            self.lengths[side] = np.diff(self.offsets[side]) + 2
+        self.pad = {side: vocabularies[side].stoi[config.get('PAD_token')] for side in SIDES}
+        self.sos = {side: vocabularies[side].stoi[config.get('SOS_token')] for side in SIDES}
+        self.eos = {side: vocabularies[side].stoi[config.get('EOS_token')] for side in SIDES}
+
+    def __len__(self):
+        return len(self.lengths['src'])
+
+    def get_batch(self, indices, device):
+        return Batch(src=self.get_side(indices, 'src', device), trg=self.get_side(indices, 'trg', device))
+
+    def get_side(self, indices, side, device):
+        tokens = self.tokens[side]
+        offsets = self.offsets[side]
+        lengths = self.lengths[side][indices]
+        batch = np.full((lengths.max(), len(indices)), self.pad[side], dtype=np.int64)
+        batch[0, :] = self.sos[side]
+        for i, index in enumerate(indices):
+            length = lengths[i]
+            batch[1:length-1, i] = tokens[offsets[index]:offsets[index+1]]
+            batch[length-1, i] = self.eos[side]
+        batch = torch.from_numpy(batch).to(device)
+        lengths = torch.from_numpy(lengths).to(device)
+        return batch, lengths
+
+
+class BatchIterator:
+    """Iterates over batches of similar length, like torchtext's BucketIterator.
+
+    Batches hold batch_size sentences, or as many sentences as fit in max_tokens
+    padded source and target tokens when max_tokens is set. A sharded iterator
+    yields every world_size-th batch starting at rank.
+    """
+
+    def __init__(self, dataset, batch_size, device, shuffle, max_tokens=None, indices=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.device = device
+        self.shuffle = shuffle
+        self.max_tokens = max_tokens
+        # examples of the dataset that are iterated over
+        self.indices = np.arange(len(dataset)) if indices is None else indices
+        self.rank = 0
+        self.world_size = 1
+        self.drop_last = False
+        self.random = random
+        # state of self.random before the batches of the current pass were created and batches yielded so far
+        self.random_state = None
+        self.position = 0
+        self.resume_state = None
+        self.tokens = 0
+        self.padded_tokens = 0
+
+    def __iter__(self):
+        self.tokens = 0
+        self.padded_tokens = 0
+        source_lengths = self.dataset.lengths['src']
+        target_lengths = self.dataset.lengths['trg']
+        if self.resume_state is not None:
+            # recreate the batches of the interrupted pass, then continue from the state random was in when it was interrupted
+            self.random.setstate(self.resume_state['random'])
+            self.random_state = self.random.getstate()
+            batches = self.create_batches()[self.resume_state['position']:]
+            self.position = self.resume_state['position']
+            self.random.setstate(self.resume_state['next_random'])
+            self.resume_state = None
+        else:
+            self.random_state = self.random.getstate()
+            batches = self.create_batches()
+            self.position = 0
+        for indices in batches:
+            self.tokens += source_lengths[indices].sum() + target_lengths[indices].sum()
+            self.padded_tokens += len(indices) * (source_lengths[indices].max() + target_lengths[indices].max())
+            self.position += 1
+            yield self.dataset.get_batch(indices, self.device)
+
+    def __len__(self):
+        """Number of batches of the next pass, without advancing random."""
+        state = self.random.getstate()
+        length = len(self.create_batches())
+        self.random.setstate(state)
+        return length
+
+    def __getstate__(self):
+        # the random module cannot be pickled, an unpickled iterator uses the random module of its process
+        state = self.__dict__.copy()
+        if state['random'] is random:
+            state['random'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.random is None:
+            self.random = random
+
+    def state_dict(self):
+        """Position in the current pass, enough to recreate its remaining batches, and the state of random for later passes."""
+        return {'random': self.random_state, 'position': self.position, 'next_random': self.random.getstate()}
+
+    def load_state_dict(self, state):
+        """The next pass continues the pass the state was taken in."""
+        self.resume_state = state
+
+    def padding_efficiency(self):
+        """Fraction of real tokens among the padded tokens of the batches iterated so far in this pass."""
+        if self.padded_tokens == 0:
+            return 1.
+        return float(self.tokens) / float(self.padded_tokens)
+
+    def create_batches(self):
+        if self.shuffle:
+            # sort pools of shuffled examples by length and shuffle the batches
+            order = self.indices.tolist()
+            self.random.shuffle(order)
+            order = np.array(order, dtype=np.int64)
+            pool_size = 100 * self.batch_size
+            batches = []
+            for start in range(0, len(order), pool_size):
+                batches.extend(self.split(self.sort(order[start:start+pool_size])))
+            self.random.shuffle(batches)
+        else:
+            batches = self.split(self.sort(self.indices))
+        if self.world_size > 1:
+            end = len(batches) // self.world_size * self.world_size if self.drop_last else len(batches)
+            batches = batches[self.rank:end:self.world_size]
+        return batches
+
+    def sort(self, indices):
+        """Sorts indices by source length and then by target length."""
+        source_lengths = self.dataset.lengths['src'][indices]
+        target_lengths = self.dataset.lengths['trg'][indices]
+        return indices[np.lexsort((target_lengths, source_lengths))]
+
+    def split(self, indices):
+        if self.max_tokens is None:
+            return [indices[i:i+self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        source_lengths = self.dataset.lengths['src'][indices]
+        target_lengths = self.dataset.lengths['trg'][indices]
+        batches = []
+        start = 0
+        max_source_length = 0
+        max_target_length = 0
+        for i in range(len(indices)):
+            max_source_length = max(max_source_length, source_lengths[i])
+            max_target_length = max(max_target_length, target_lengths[i])
+            if i > start and (i - start + 1) * (max_source_length + max_target_length) > self.max_tokens:
+                batches.append(indices[start:i])
+                start = i
+                max_source_length = source_lengths[i]
+                max_target_length = target_lengths[i]
+        if start < len(indices):
+            batches.append(indices[start:])
+        return batches
+
+    def sample(self, k):
+        """Batch of k random examples."""
+        indices = np.array(self.random.sample(self.indices.tolist(), k))
+        return self.dataset.get_batch(indices, self.device)
+
+    def shard(self, rank, world_size, seed=0, drop_last=False):
+        """Iterator over the batches of one of world_size processes.
+
+        All shards shuffle with the same seed, so the shards of an epoch are
+        disjoint. drop_last gives every shard the same number of batches.
+        """
+        iterator = BatchIterator(self.dataset, self.batch_size, self.device, self.shuffle, self.max_tokens, self.indices)
+        iterator.rank = rank
+        iterator.world_size = world_size
+        iterator.drop_last = drop_last
+        iterator.random = random.Random(seed)
+        return iterator
+
+    def stratified_subset(self, k, seed=0):
+        """Iterator over a fixed subset of k examples, one from each of k strata of similar source length."""
+        order = self.indices[np.argsort(self.dataset.lengths['src'][self.indices], kind='stable')]
+        strata = [stratum for stratum in np.array_split(order, min(k, len(order))) if len(stratum) > 0]
+        random_state = np.random.RandomState(seed)
+        indices = np.sort([stratum[random_state.randint(len(stratum))] for stratum in strata])
+        iterator = BatchIterator(self.dataset, self.batch_size, self.device, self.shuffle, self.max_tokens, indices)
+        if self.world_size > 1:
+            iterator = iterator.shard(self.rank, self.world_size, seed, self.drop_last)
+        return iterator
+
+
+def load_cached(config, csv_dir_path, source_tokenizer, target_tokenizer, device):
+    """Loads a dataset from its preprocessed cache, preprocessing the csv files on first use."""
+    print(f'Data loader: Started ({csv_dir_path}).')
+    digest, key = get_cache_key(config, csv_dir_path, source_tokenizer, target_tokenizer)
+    cache_path = os.path.join(csv_dir_path, 'cache', digest)
+    if not os.path.exists(cache_path):
+        build_cache(config, csv_dir_path, cache_path, key, source_tokenizer, target_tokenizer)
+
+    with open(f'{cache_path}/vocabulary.json', 'r') as f:
+        vocabularies = {side: Vocabulary(itos) for side, itos in json.load(f).items()}
+    train = Dataset(cache_path, 'train', vocabularies, config)
+    val = Dataset(cache_path, 'val', vocabularies, config)
+    batch_size = config.get('batch_size')
+    max_tokens = config.get('max_tokens')
+    train_iter = BatchIterator(train, batch_size, device, shuffle=True, max_tokens=max_tokens)
+    val_iter = BatchIterator(val, batch_size, device, shuffle=False, max_tokens=max_tokens)
+
+    print('Data loader: Finished.')
+
+    return train_iter, val_iter, vocabularies['src'], vocabularies['trg'], val
@@ -0,0 +1,176 @@
+from device import with_cpu
+import torch
+import torch.nn.functional as F
+
+
+def get_max_lengths(source_lengths, max_length_ratio):
+    """Maximum number of decoding steps of every sentence relative to its source length."""
+    return torch.ceil(source_lengths.float() * max_length_ratio).long()
+
+
+def get_length_penalty(length, alpha):
+    """Length penalty of Wu et al. 2016, an alpha of 0 disables the penalty."""
+    return ((5. + length) / 6.) ** alpha
+
+
+def greedy_search(model, batch, max_length_ratio, check_every=2, compact_fraction=0.25):
+    """Translates a batch greedily.
+
+    Decoding stops for a sentence once it produces <eos> or reaches its maximum
+    length. Finished rows are fed <eos> and masked on the device, so a step does
+    not wait for the host. Every check_every steps the number of finished rows is
+    read back: decoding ends once all rows have finished, and the finished rows
+    are dropped from the model state once they make up compact_fraction of the
+    batch. Tokens are accumulated on the device and copied back once.
+
+    The model must implement encode(batch), step(input, state) and
+    reorder_state(state, indices).
+
+    Returns:
+        List of translations (lists of token indices) in the order of the batch.
+    """
+    device = model.device
+    _, source_lengths = batch.src
+    batch_size = source_lengths.size(0)
+    max_lengths = get_max_lengths(source_lengths, max_length_ratio)
+    max_length = max_lengths.max().item()
+
+    state = model.encode(batch)
+    input = torch.full((1, batch_size), model.sos, device=device, dtype=torch.long)
+    tokens = torch.full((max_length, batch_size), model.pad_trg, device=device, dtype=torch.long)
+    translation_lengths = torch.zeros_like(max_lengths)
+    # batch index, maximum length, number of decoded words and whether it has finished of every active row
+    rows = torch.arange(batch_size, device=device, dtype=torch.long)
+    row_max_lengths = max_lengths
+    lengths = torch.zeros_like(max_lengths)
+    finished = torch.zeros(batch_size, device=device, dtype=torch.bool)
+
+    for t in range(max_length):
+        y, state = model.step(input, state)
+        _, words = y.max(1)
+        words.masked_fill_(finished, model.eos)
+        tokens[t].index_copy_(0, rows, words)
+        lengths += ~finished
+        finished |= words == model.eos
+        input = words.view(1, -1)
+
+        if (t + 1) % check_every == 0:
+            finished |= row_max_lengths <= t + 1
+            n_finished = finished.sum().item()
+            if n_finished == finished.size(0):
+                break
+            if n_finished >= compact_fraction * finished.size(0):
+                translation_lengths.index_copy_(0, rows, lengths)
+                keep = (~finished).nonzero().view(-1)
+                input = input.index_select(1, keep)
+                rows = rows.index_select(0, keep)
+                row_max_lengths = row_max_lengths.index_select(0, keep)
+                lengths = lengths.index_select(0, keep)
+                finished = finished.index_select(0, keep)
+                state = model.reorder_state(state, keep)
+    translation_lengths.index_copy_(0, rows, lengths)
+    # rows only stop at their maximum length when they are checked
+    translation_lengths = torch.min(translation_lengths, max_lengths)
+
+    tokens = with_cpu(tokens).t().tolist()
+    translation_lengths = with_cpu(translation_lengths).tolist()
+    return [sentence[:length] for sentence, length in zip(tokens, translation_lengths)]
+
+
+def beam_search(model, batch, beam_width, max_length_ratio, alpha):
+    """Translates a batch with beam search.
+
+    The batch_size x beam_width hypotheses are kept in flat tensors and the model
+    state is reordered with index_select after every step. A sentence is retired
+    from the batch once its best hypothesis has ended in <eos> or it has reached its
+    maximum length, so the batch shrinks as sentences complete.
+
+    The model must implement encode(batch), step(input, state) and
+    reorder_state(state, indices, within_sentences), where within_sentences tells
+    that the indices only reorder hypotheses of the same sentences.
+
+    Returns:
+        List of translations (lists of token indices) in the order of the batch.
+    """
+    device = model.device
+    eos = model.eos
+    K = beam_width
+    _, source_lengths = batch.src
+    batch_size = source_lengths.size(0)
+    max_lengths = get_max_lengths(source_lengths, max_length_ratio)
+    max_length = max_lengths.max().item()
+    beams = torch.arange(K, device=device, dtype=torch.long)
+
+    # expand every sentence to K hypotheses of which only the first is alive
+    state = model.encode(batch)
+    rows = torch.arange(batch_size, device=device, dtype=torch.long)
+    rows = rows.view(-1, 1).repeat(1, K).view(-1)
+    state = model.reorder_state(state, rows)
+    scores = torch.full((batch_size, K), float('-inf'), device=device)
+    scores[:, 0] = 0
+    input = torch.full((1, batch_size * K), model.sos, device=device, dtype=torch.long)
+    history = torch.empty((batch_size * K, 0), device=device, dtype=torch.long)
+
+    # per active sentence
+    sentence_ids = torch.arange(batch_size, device=device, dtype=torch.long)
+    best_scores = torch.full((batch_size,), float('-inf'), device=device)
+    translations = [[] for _ in range(batch_size)]
+
+    for t in range(1, max_length + 1):
+        n = sentence_ids.size(0)
+        y, state = model.step(input, state)
+        log_probs = F.log_softmax(y.float(), dim=1)
+        V = log_probs.size(1)
+
+        # n x K
+        candidates = scores.view(-1, 1) + log_probs
+        scores, indices = candidates.view(n, K * V).topk(K, dim=1)
+        words = indices % V
+        rows = torch.arange(n, device=device, dtype=torch.long).view(-1, 1) * K + indices // V
+        rows = rows.view(-1)
+        history = torch.cat((history.index_select(0, rows), words.view(-1, 1)), 1)
+        state = model.reorder_state(state, rows, within_sentences=True)
+
+        # hypotheses ending in <eos> and every hypothesis at maximum length are complete
+        finished = words == eos
+        at_max_length = (max_lengths <= t).view(-1, 1)
+        ended = finished | at_max_length
+        normalized = scores / get_length_penalty(t, alpha)
+        ended_scores = normalized.masked_fill(~ended, float('-inf'))
+        best_ended_scores, best_ended_beams = ended_scores.max(1)
+        improved = best_ended_scores > best_scores
+        if improved.any():
+            for i in improved.nonzero().view(-1).tolist():
+                row = i * K + best_ended_beams[i].item()
+                translations[sentence_ids[i].item()] = history[row].tolist()
+            best_scores = torch.where(improved, best_ended_scores, best_scores)
+
+        # finished hypotheses are not extended, topk sorts the beams so the first is the best
+        scores = scores.masked_fill(finished, float('-inf'))
+        done = ended[:, 0] | at_max_length.view(-1)
+        if done.all():
+            break
+        if done.any():
+            keep = (~done).nonzero().view(-1)
+            keep_rows = (keep.view(-1, 1) * K + beams).view(-1)
+            scores = scores.index_select(0, keep)
+            words = words.index_select(0, keep)
+            sentence_ids = sentence_ids.index_select(0, keep)
+            max_lengths = max_lengths.index_select(0, keep)
+            best_scores = best_scores.index_select(0, keep)
+            history = history.index_select(0, keep_rows)
+            state = model.reorder_state(state, keep_rows)
+        input = words.view(1, -1)
+
+    return translations
+
+
+def decode(config, batch):
+    """Translates a batch with the decoding strategy of the configuration."""
+    model = config.get('model')
+    beam_width = config.get('beam_width')
+    max_length_ratio = config.get('max_length_ratio')
+    if beam_width > 1:
+        length_penalty = config.get('length_penalty')
+        return beam_search(model, batch, beam_width, max_length_ratio, length_penalty)
+    return greedy_search(model, batch, max_length_ratio)
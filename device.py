@@ -1,22 +1,31 @@
-from io import BytesIO
-import pandas as pd
+import contextlib
+import os
 import torch
+import torch.distributed as dist
 import subprocess
-import sys
 
 
 USE_GPU = torch.cuda.is_available()
+PRECISIONS = {
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+    'fp32': torch.float32,
+}
 
 
 def select_device():
-    """Selects GPU with the most available memory or CPU if cuda is not enabled."""
-    if USE_GPU:
+    """Selects GPU with the most available memory or CPU if cuda is not enabled.
+
+    Processes started by torchrun use the GPU of their local rank.
+    """
+    if USE_GPU and get_world_size() > 1:
+        device_idx = int(os.environ.get('LOCAL_RANK', 0))
+        device = torch.device(f'cuda:{device_idx}')
+    elif USE_GPU:
         try:
-            gpus = subprocess.check_output(['nvidia-smi', '--format=csv', '--query-gpu=memory.used,memory.free'])
-            stream = BytesIO(gpus)
-            dataframe = pd.read_csv(stream, names=['memory.used', 'memory.free'], skiprows=1)
-            dataframe['memory.free'] = dataframe['memory.free'].map(lambda x: float(x.rstrip(' [MiB]')))
-            device_idx = dataframe['memory.free'].idxmax()
+            gpus = subprocess.check_output(['nvidia-smi', '--format=csv,noheader,nounits', '--query-gpu=memory.free'])
+            memory_free = [float(line) for line in gpus.decode('utf-8').split()]
+            device_idx = memory_free.index(max(memory_free))
             device = torch.device(f'cuda:{device_idx}')
         except Exception:
             device_idx = -1
@@ -39,3 +48,106 @@ def with_gpu(x):
         return x.cuda()
     else:
         return x
+
+
+def check_precision(precision, device):
+    if precision not in PRECISIONS:
+        raise Exception(f'Unknown precision: {precision}')
+    if precision != 'fp32' and not hasattr(torch, 'autocast'):
+        raise Exception(f'Precision {precision} needs torch.autocast')
+    if precision == 'fp16' and device.type != 'cuda':
+        raise Exception('Precision fp16 needs a cuda device, use bf16 on cpu')
+
+
+def autocast(precision, device):
+    """Context running the model at the given precision, fp32 runs without autocast."""
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=PRECISIONS[precision])
+
+
+def get_grad_scaler(precision):
+    """Gradient scaler that keeps small fp16 gradients from underflowing, None for other precisions."""
+    if precision == 'fp16':
+        return torch.amp.GradScaler('cuda')
+    return None
+
+
+def get_available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def configure_cpu(threads=None, interop_threads=None, affinity=False, local_rank=0, local_world_size=1, cores=None):
+    """Sets the threads torch uses on the cpu and optionally pins the process to cores.
+
+    The cores are split evenly between the local_world_size processes of a
+    machine, threads defaults to the cores of one process. The model has no
+    inter-op parallelism, so interop_threads defaults to 1. With affinity the
+    process of local_rank is pinned to its share of the cores. cores limits the
+    split to some of the available cores. Returns the settings that were applied.
+    """
+    cpus = cores or get_available_cpus()
+    per_process = max(1, len(cpus) // local_world_size)
+    if affinity and hasattr(os, 'sched_setaffinity'):
+        cores = cpus[local_rank * per_process:(local_rank + 1) * per_process] or cpus
+        os.sched_setaffinity(0, cores)
+    else:
+        cores = cpus
+    threads = threads or per_process
+    interop_threads = interop_threads or 1
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(interop_threads)
+    except RuntimeError:
+        # can only be set once and before any inter-op parallel work
+        interop_threads = torch.get_num_interop_threads()
+    return {'threads': threads, 'interop_threads': interop_threads, 'affinity': affinity, 'cores': cores}
+
+
+def init_distributed(backend='gloo'):
+    """Joins the process group when started by torchrun, returns the rank and the number of processes."""
+    if int(os.environ.get('WORLD_SIZE', 1)) > 1 and not dist.is_initialized():
+        dist.init_process_group(backend=backend)
+    return get_rank(), get_world_size()
+
+
+def get_rank():
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank()
+    return 0
+
+
+def get_world_size():
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_world_size()
+    return 1
+
+
+def all_gather_object(value):
+    """Values of all processes ordered by rank, a list of the value itself when running in a single process."""
+    if dist.is_available() and dist.is_initialized():
+        values = [None] * dist.get_world_size()
+        dist.all_gather_object(values, value)
+        return values
+    return [value]
+
+
+def all_reduce_sum(tensor):
+    """Sum of a tensor over all processes, the tensor itself when running in a single process."""
+    if dist.is_available() and dist.is_initialized():
+        tensor = tensor.clone()
+        dist.all_reduce(tensor)
+    return tensor
+
+
+@contextlib.contextmanager
+def main_process_first():
+    """Lets the process of rank 0 run the block before the other processes, e.g. to build a shared cache."""
+    distributed = dist.is_available() and dist.is_initialized()
+    if distributed and dist.get_rank() != 0:
+        dist.barrier()
+    yield
+    if distributed and dist.get_rank() == 0:
+        dist.barrier()
@@ -0,0 +1,132 @@
+from dataset import BatchIterator
+from device import configure_cpu
+import time
+import torch
+import torch.multiprocessing as mp
+
+
+# entries of the training configuration that the evaluation process does not need or cannot receive
+EXCLUDED_KEYS = ['grad_scaler', 'model', 'optimizer', 'parallel_model', 'train_iter', 'val_iter', 'val_dataset']
+
+
+def to_cpu_iterator(iterator):
+    if iterator is None:
+        return None
+    cpu = torch.device('cpu')
+    return BatchIterator(iterator.dataset, iterator.batch_size, cpu, False, iterator.max_tokens, iterator.indices)
+
+
+class AsyncEvaluator:
+    """Evaluates snapshots of the model in a separate process while training continues.
+
+    Snapshots are copied into one of two state dicts in shared memory. The
+    evaluation process copies the pending snapshot into its own CPU model, which
+    frees the buffer, and writes bleu, loss and eval_seconds to the validation
+    log. At most one snapshot waits at a time, a newer one replaces it so a slow
+    evaluation only ever falls behind by one snapshot.
+    """
+
+    def __init__(self, config, writer_path, val_iter, val_subset_iter=None):
+        context = mp.get_context('spawn')
+        model = config.get('model')
+        self.buffers = [
+            {name: tensor.detach().cpu().clone().share_memory_() for name, tensor in model.state_dict().items()}
+            for _ in range(2)
+        ]
+        self.condition = context.Condition()
+        # shared state guarded by the condition, -1 when there is no snapshot
+        self.pending = context.Value('i', -1, lock=False)
+        self.pending_step = context.Value('i', 0, lock=False)
+        self.pending_full = context.Value('b', True, lock=False)
+        self.busy = context.Value('i', -1, lock=False)
+        self.stopped = context.Value('b', False, lock=False)
+        self.dropped = 0
+        evaluation_config = {key: value for key, value in config.items() if key not in EXCLUDED_KEYS}
+        self.process = context.Process(
+            target=run_evaluation,
+            args=(
+                evaluation_config,
+                writer_path,
+                to_cpu_iterator(val_iter),
+                to_cpu_iterator(val_subset_iter),
+                self.buffers,
+                self.condition,
+                self.pending,
+                self.pending_step,
+                self.pending_full,
+                self.busy,
+                self.stopped,
+            ),
+            daemon=True,
+        )
+        self.process.start()
+
+    def submit(self, model, step, full=True):
+        """Hands a snapshot of the model to the evaluation process, replacing a snapshot that is still waiting."""
+        with self.condition:
+            if self.pending.value != -1:
+                buffer = self.pending.value
+                self.dropped += 1
+            else:
+                buffer = 1 - self.busy.value if self.busy.value != -1 else 0
+            for name, tensor in model.state_dict().items():
+                self.buffers[buffer][name].copy_(tensor)
+            self.pending.value = buffer
+            self.pending_step.value = step
+            self.pending_full.value = full
+            self.condition.notify()
+
+    def close(self):
+        """Waits for the waiting snapshot to be evaluated and stops the evaluation process."""
+        with self.condition:
+            self.stopped.value = True
+            self.condition.notify()
+        self.process.join()
+        if self.dropped > 0:
+            print(f'Evaluation: dropped {self.dropped} stale snapshots.')
+        if self.process.exitcode != 0:
+            raise Exception(f'Evaluation process failed with exit code {self.process.exitcode}')
+
+
+def run_evaluation(config, writer_path, val_iter, val_subset_iter, buffers, condition, pending, pending_step, pending_full,
+                   busy, stopped):
+    from main import validate
+    from model import Model
+    from model_without_attention import ModelWithoutAttention
+    from tensorboardX import SummaryWriter
+    device = torch.device('cpu')
+    # a spawned process would use all cores, it takes eval_threads of the training process' cores, pinned to the last ones
+    cpu = config.get('cpu')
+    threads = config.get('training').get('eval_threads', 1)
+    configure_cpu(threads, 1, cpu.get('affinity'), cores=cpu.get('cores')[-threads:])
+    if config.get('precision') == 'fp16':
+        # fp16 autocast is meant for cuda, the cpu copy evaluates in fp32
+        config['precision'] = 'fp32'
+    if config.get('use_attention'):
+        config['model'] = Model(config, device)
+    else:
+        config['model'] = ModelWithoutAttention(config, device)
+    writer = SummaryWriter(log_dir=writer_path, filename_suffix='.evaluation')
+    while True:
+        with condition:
+            while pending.value == -1 and not stopped.value:
+                condition.wait()
+            if pending.value == -1:
+                break
+            buffer = pending.value
+            step = pending_step.value
+            full = pending_full.value
+            pending.value = -1
+            busy.value = buffer
+        config['model'].load_state_dict(buffers[buffer])
+        with condition:
+            busy.value = -1
+
+        suffix = '' if full else '_subset'
+        start = time.perf_counter()
+        val_loss, bleu = validate(config, val_iter if full else val_subset_iter)
+        writer.add_scalar(f'bleu{suffix}', bleu, step)
+        writer.add_scalar(f'loss{suffix}', val_loss, step)
+        writer.add_scalar(f'eval_seconds{suffix}', time.perf_counter() - start, step)
+        writer.flush()
+    writer.close()
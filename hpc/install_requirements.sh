@@ -1,4 +1,4 @@
-conda install pytorch torchvision cuda92 ignite -c pytorch -y
-pip install --user tensorflow grpcio msgpack torchtext spacy tensorboardX download
-python -m spacy download de
-python -m spacy download en
+conda create -n nmt python=3.11.7 -y
+conda run -n nmt pip install torch==2.14.1 numpy==2.4.6 matplotlib==3.11.2 tensorboardX==2.6.5 "spacy>=3,<4"
+conda run -n nmt python -m spacy download de_core_news_sm
+conda run -n nmt python -m spacy download en_core_web_sm
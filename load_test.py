@@ -0,0 +1,95 @@
+import argparse
+import csv
+import http.client
+import json
+import random
+import threading
+import time
+
+
+def percentile(values, q):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def read_sentences(path):
+    with open(path, 'r') as f:
+        if path.endswith('.csv'):
+            return [row['src'] for row in csv.DictReader(f)]
+        return [line.rstrip('\n') for line in f]
+
+
+def run_client(args, sentences, n_requests, latencies, errors):
+    connection = http.client.HTTPConnection(args.host, args.port)
+    headers = {'Content-Type': 'application/json'}
+    for _ in range(n_requests):
+        body = json.dumps({'sentences': random.sample(sentences, args.sentences_per_request)})
+        start = time.perf_counter()
+        try:
+            connection.request('POST', '/translate', body, headers)
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+                continue
+        except (http.client.HTTPException, OSError) as exception:
+            errors.append(str(exception))
+            connection.close()
+            connection = http.client.HTTPConnection(args.host, args.port)
+            continue
+        latencies.append(time.perf_counter() - start)
+    connection.close()
+
+
+def get_metrics(args):
+    connection = http.client.HTTPConnection(args.host, args.port)
+    connection.request('GET', '/metrics')
+    metrics = json.loads(connection.getresponse().read().decode('utf-8'))
+    connection.close()
+    return metrics
+
+
+def main():
+    args = parse_arguments()
+    sentences = read_sentences(args.input)
+    latencies = []
+    errors = []
+    requests_per_client = [args.requests // args.concurrency] * args.concurrency
+    for i in range(args.requests % args.concurrency):
+        requests_per_client[i] += 1
+    clients = [
+        threading.Thread(target=run_client, args=(args, sentences, n_requests, latencies, errors))
+        for n_requests in requests_per_client
+    ]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    seconds = time.perf_counter() - start
+
+    n_sentences = len(latencies) * args.sentences_per_request
+    print(f'Requests: {len(latencies)} succeeded, {len(errors)} failed in {seconds:.2f}s')
+    print(f'Throughput: {len(latencies) / seconds:.1f} requests/sec, {n_sentences / seconds:.1f} sentences/sec')
+    if len(latencies) > 0:
+        print(f'Latency: p50 {percentile(latencies, 50) * 1000:.1f} ms, p99 {percentile(latencies, 99) * 1000:.1f} ms')
+    print(f'Server metrics: {json.dumps(get_metrics(args), indent=2)}')
+
+
+def parse_arguments():
+    default_input = '.data/dummy_variable_length/val.csv'
+    parser = argparse.ArgumentParser(description='Generate load against the translation server.')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Host of the server.')
+    parser.add_argument('--port', type=int, default=8000, help='Port of the server.')
+    parser.add_argument('--input', type=str, default=default_input, help='Sentences (text file or csv with a src column).')
+    parser.add_argument('--requests', type=int, default=1000, help='Total number of requests.')
+    parser.add_argument('--concurrency', type=int, default=16, help='Number of concurrent clients.')
+    parser.add_argument('--sentences_per_request', type=int, default=1, help='Sentences sent with every request.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,26 @@
-from bleu import compute_bleu
-from device import select_device, with_cpu, with_gpu
-import json
-from parse import get_config
-from random import sample
-from tensorboardX import SummaryWriter
-import torchtext
+from bleu import BleuAccumulator
+from checkpoint import CheckpointWriter, get_rng_state, load_latest_checkpoint, save_atomic, set_rng_state
+from decoding import decode
+from device import all_gather_object, all_reduce_sum, autocast, get_rank, get_world_size, init_distributed, select_device, with_cpu
+from evaluator import AsyncEvaluator
+from functools import partial
+from parse import get_config, save_vocabularies
+from summary import BackgroundWriter
+import contextlib
+import time
 import torch
+import torch.distributed as dist
 from torch.nn.utils import clip_grad_norm_
-from utils import filter_words, get_or_create_dir, get_text, list2words, torch2words
+from utils import batch2ids, get_or_create_dir, get_text, list2words, pad_sentences, torch2words
 from visualize import visualize_attention
 
 
 def main():
+    # a no-op unless started by torchrun
+    rank, world_size = init_distributed()
     use_gpu, device, device_idx = select_device()
+    if world_size > 1:
+        print(f'Process {rank + 1}/{world_size}')
     if use_gpu:
         device_name = torch.cuda.get_device_name(device_idx)
         print(f'Using device: {device} ({device_name})')
@@ -21,35 +29,23 @@ def main():
     else:
         print(f'Using device: cpu')
         run(use_gpu, device, device_idx)
+    if world_size > 1:
+        dist.destroy_process_group()
 
 
 def run(use_gpu, device, device_idx):
     config = get_config(use_gpu, device, device_idx)
     val_iter = config.get('val_iter')
-    val_data = val_iter.data()
-    val_dataset = config.get('val_dataset')
-
-    def sample_validation_batches(k):
-        return torchtext.data.Batch(sample(val_data, k), val_dataset, device)
+    cpu = config.get('cpu')
+    print(f'Using {cpu["threads"]} threads and {cpu["interop_threads"]} inter-op threads on {len(cpu["cores"])} cores')
 
     # save source and target language vocabularies
     source_language = config.get('src_language')
     target_language = config.get('trg_language')
-    data = {
-        "source": {
-            "itos": source_language.itos,
-            "stoi": source_language.stoi,
-        },
-        "target": {
-            "itos": target_language.itos,
-            "stoi": target_language.stoi,
-        },
-    }
-    weights_path = config.get('weights_path')
-    with open(f'{weights_path}/language.json', 'w') as f:
-        json.dump(data, f)
+    if get_rank() == 0:
+        save_vocabularies(config.get('weights_path'), source_language, target_language)
 
-    train(config, sample_validation_batches)
+    train(config, val_iter.sample)
 
 
 def train(config, sample_validation_batches):
@@ -63,44 +59,70 @@ def train(config, sample_validation_batches):
     writer_path = config.get('writer_path')
     writer_train_path = get_or_create_dir(writer_path, 'train')
     writer_val_path = get_or_create_dir(writer_path, 'val')
-    writer_train = SummaryWriter(log_dir=writer_train_path)
-    writer_val = SummaryWriter(log_dir=writer_val_path)
+    # with several processes only the first one logs, samples translations and saves weights
+    is_main = get_rank() == 0
+    world_size = get_world_size()
+    if is_main:
+        writer_train = BackgroundWriter(writer_train_path)
+        writer_val = BackgroundWriter(writer_val_path)
     epochs = config.get('epochs')
     training = config.get('training')
     eval_every = training.get('eval_every')
     sample_every = training.get('sample_every')
+    log_every = training.get('log_every', 10)
+    # the optimizer steps once per gradient_accumulation_steps batches, which is what step counts
+    gradient_accumulation_steps = training.get('gradient_accumulation_steps', 1)
     use_attention = config.get('use_attention')
+    # evaluate on a fixed subset of the validation set with periodic full passes
+    val_subset_size = training.get('val_subset_size')
+    val_subset_iter = None if val_subset_size is None else val_iter.stratified_subset(val_subset_size)
+    full_eval_every = training.get('full_eval_every', 10 * eval_every)
+    # evaluate snapshots of the model in a separate process instead of pausing training
+    evaluator = None
+    if training.get('async_eval', False) and is_main:
+        evaluator = AsyncEvaluator(config, writer_val_path, val_iter, val_subset_iter)
+    # checkpoints to resume from are written every checkpoint_every steps, keeping the newest keep_checkpoints
+    checkpoint_every = training.get('checkpoint_every')
+    checkpoint_path = get_or_create_dir(config.get('weights_path'), 'checkpoints')
+    checkpoint_writer = None
+    if checkpoint_every is not None and is_main:
+        checkpoint_writer = CheckpointWriter(checkpoint_path, training.get('keep_checkpoints', 3))
     step = 1
-    for epoch in range(epochs):
-        print(f'Epoch: {epoch+1}/{epochs}')
-        save_weights(config)
-        for i, training_batch in enumerate(train_iter):
-            loss = train_batch(config, training_batch)
-            writer_train.add_scalar('loss', loss, step)
+    start_epoch = 0
+    if config.get('resume'):
+        start_epoch, step = resume(config, checkpoint_path)
+    # losses are summed on the device and only read when they are logged
+    train_losses = 0
+    train_lengths = 0
+    for epoch in range(start_epoch, epochs):
+        if is_main:
+            print(f'Epoch: {epoch+1}/{epochs}')
+            save_weights(config)
+        for training_batches in group_batches(train_iter, gradient_accumulation_steps):
+            train_losses += train_batch(config, training_batches)
+            train_lengths += 1
+            if step % log_every == 0:
+                if world_size > 1:
+                    train_losses = all_reduce_sum(train_losses) / world_size
+                if is_main:
+                    writer_train.add_scalar('loss', train_losses / train_lengths, step)
+                train_losses = 0
+                train_lengths = 0
 
             if step == 1 or step % eval_every == 0:
-                val_lengths = 0
-                val_losses = 0
-                reference_corpus = []
-                translation_corpus = []
-                for val_batch in val_iter:
-                    val_loss, translations = evaluate_batch(config, val_batch)
-                    val_lengths += 1
-                    val_losses += val_loss
-                    val_batch_trg, _ = val_batch.trg
-                    _, batch_size = val_batch_trg.shape
-                    references = map(lambda i: torch2words(target_language, val_batch_trg[:, i]), range(batch_size))
-                    references = map(lambda words: [list(filter_words(words, SOS_token, EOS_token, PAD_token))], references)
-                    reference_corpus.extend(references)
-                    translations = map(lambda translation: list2words(target_language, translation), translations)
-                    translations = map(lambda words: list(filter_words(words, SOS_token, EOS_token, PAD_token)), translations)
-                    translation_corpus.extend(translations)
-                bleu = compute_bleu(reference_corpus, translation_corpus)
-                val_loss = val_losses / val_lengths
-                writer_val.add_scalar('bleu', bleu, step)
-                writer_val.add_scalar('loss', val_loss, step)
-
-            if step % sample_every == 0:
+                full = val_subset_iter is None or step % full_eval_every == 0
+                if evaluator is not None:
+                    evaluator.submit(config.get('model'), step, full)
+                elif not training.get('async_eval', False):
+                    suffix = '' if full else '_subset'
+                    start = time.perf_counter()
+                    val_loss, bleu = validate(config, val_iter if full else val_subset_iter)
+                    if is_main:
+                        writer_val.add_scalar(f'bleu{suffix}', bleu, step)
+                        writer_val.add_scalar(f'loss{suffix}', val_loss, step)
+                        writer_val.add_scalar(f'eval_seconds{suffix}', time.perf_counter() - start, step)
+
+            if step % sample_every == 0 and is_main:
                 val_batch = sample_validation_batches(1)
                 val_batch_src, val_lengths_src = val_batch.src
                 val_batch_trg, _ = val_batch.trg
@@ -110,56 +132,184 @@ def train(config, sample_validation_batches):
                 target_words = torch2words(target_language, val_batch_trg[:, 0])
                 translation_words = list(filter(lambda word: word != PAD_token, list2words(target_language, translations[0])))
                 if use_attention and sum(attention_weights.shape) != 0:
-                    attention_figure = visualize_attention(source_words[:s0], translation_words, with_cpu(attention_weights))
-                    writer_val.add_figure('attention', attention_figure, step)
+                    render = partial(visualize_attention, source_words[:s0], translation_words, with_cpu(attention_weights))
+                    writer_val.add_figure('attention', render, step)
                 text = get_text(source_words, target_words, translation_words, SOS_token, EOS_token, PAD_token)
                 writer_val.add_text('translation', text, step)
 
+            if checkpoint_every is not None and step % checkpoint_every == 0:
+                # every process continues with its own random numbers after resuming
+                rng = all_gather_object(get_rng_state())
+                if checkpoint_writer is not None:
+                    checkpoint_writer.save(get_checkpoint(config, step, epoch, rng), step)
+
             step += 1
 
-    save_weights(config)
+        if is_main:
+            padding_efficiency = train_iter.padding_efficiency()
+            print(f'Padding efficiency: {padding_efficiency:.3f}')
+            writer_train.add_scalar('padding_efficiency', padding_efficiency, step)
+
+    if is_main:
+        save_weights(config)
+        writer_train.close()
+        writer_val.close()
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
+    if evaluator is not None:
+        evaluator.close()
+
+
+def get_checkpoint(config, step, epoch, rng):
+    scaler = config.get('grad_scaler')
+    return {
+        'model': config.get('model').state_dict(),
+        'optimizer': config.get('optimizer').state_dict(),
+        'grad_scaler': None if scaler is None else scaler.state_dict(),
+        'step': step,
+        'epoch': epoch,
+        'iterator': config.get('train_iter').state_dict(),
+        # random number generator states of all processes, ordered by rank
+        'rng': rng,
+    }
+
 
+def resume(config, checkpoint_path):
+    """Restores the newest checkpoint, returns the epoch and the step to continue with."""
+    model = config.get('model')
+    checkpoint = load_latest_checkpoint(checkpoint_path, model.device)
+    is_main = get_rank() == 0
+    if checkpoint is None:
+        if is_main:
+            print(f'No checkpoint in {checkpoint_path}, starting from scratch.')
+        return 0, 1
+    model.load_state_dict(checkpoint['model'])
+    config.get('optimizer').load_state_dict(checkpoint['optimizer'])
+    scaler = config.get('grad_scaler')
+    if scaler is not None and checkpoint['grad_scaler'] is not None:
+        scaler.load_state_dict(checkpoint['grad_scaler'])
+    config.get('train_iter').load_state_dict(checkpoint['iterator'])
+    rng = checkpoint['rng']
+    if len(rng) != get_world_size() and is_main:
+        print(f'Checkpoint of {len(rng)} processes, random numbers do not continue exactly.')
+    set_rng_state(rng[get_rank() % len(rng)])
+    if is_main:
+        print(f'Resuming from step {checkpoint["step"]} (epoch {checkpoint["epoch"] + 1}).')
+    return checkpoint['epoch'], checkpoint['step'] + 1
+
+
+def validate(config, val_iter):
+    """Loss and BLEU on a validation iterator, accumulated batch by batch.
+
+    With several processes every process evaluates its shard of the validation
+    set and the losses and BLEU statistics of all shards are summed.
+    """
+    EOS = config.get('EOS')
+    PAD_trg = config.get('PAD_trg')
+    SOS = config.get('SOS')
+    val_lengths = 0
+    val_losses = 0
+    bleu = BleuAccumulator()
+    for val_batch in val_iter:
+        val_loss, translations = evaluate_batch(config, val_batch)
+        val_lengths += 1
+        val_losses += val_loss
+        val_batch_trg, _ = val_batch.trg
+        references = batch2ids(with_cpu(val_batch_trg).t().numpy(), SOS, EOS, PAD_trg)
+        translations = batch2ids(pad_sentences(translations, PAD_trg), SOS, EOS, PAD_trg)
+        bleu.add([[reference] for reference in references], translations)
+    if get_world_size() > 1:
+        device = config.get('model').device
+        totals = torch.stack([torch.as_tensor(val_losses, dtype=torch.float, device=device), torch.tensor(float(val_lengths), device=device)])
+        val_losses, val_lengths = all_reduce_sum(totals)
+        bleu.statistics = all_reduce_sum(torch.from_numpy(bleu.statistics)).numpy()
+    return val_losses / val_lengths, bleu.score()
+
+
+def group_batches(iterator, size):
+    batches = []
+    for batch in iterator:
+        batches.append(batch)
+        if len(batches) == size:
+            yield batches
+            batches = []
+    if len(batches) > 0:
+        yield batches
 
-def train_batch(config, batch):
+
+def train_batch(config, batches):
+    """One optimizer step on the gradients accumulated over a list of batches.
+
+    Every batch is weighted by its share of the sentences, so the returned loss
+    and the gradients are those of one batch holding all the sentences. With
+    several processes the sentences of all processes are counted and the
+    losses returned by the processes average to the loss of all of them.
+    """
     model = config.get('model')
+    parallel_model = config.get('parallel_model', model)
     optimizer = config.get('optimizer')
     gradient_clipping = config.get('gradient_clipping')
+    scaler = config.get('grad_scaler')
+    n_sentences = sum(batch.trg[1].size(0) for batch in batches)
+    world_size = get_world_size()
+    if world_size > 1:
+        # the gradients are averaged over the processes, which undoes the factor world_size, and the
+        # count stays on the device so the step does not wait for it
+        n_sentences = all_reduce_sum(torch.tensor(n_sentences, device=model.device, dtype=torch.float)) / world_size
 
     model.train()
-    ys = model(batch)
-    loss = get_loss(config, batch, ys)
-
     optimizer.zero_grad()
-    loss.backward()
-    if gradient_clipping:
-        clip_grad_norm_(model.parameters(), 1)
-    optimizer.step()
+    total_loss = 0
+    for i, batch in enumerate(batches):
+        # gradients are only averaged across processes after the last batch
+        last = i == len(batches) - 1
+        with parallel_model.no_sync() if world_size > 1 and not last else contextlib.nullcontext():
+            with autocast(config.get('precision'), model.device):
+                ys = parallel_model(batch)
+            # the model returns fp32 scores, so the masked loss is computed in fp32
+            loss = get_loss(config, batch, ys) * (batch.trg[1].size(0) / n_sentences)
+            if scaler is not None:
+                scaler.scale(loss).backward()
+            else:
+                loss.backward()
+        total_loss += loss.detach()
+
+    if scaler is not None:
+        if gradient_clipping:
+            scaler.unscale_(optimizer)
+            clip_grad_norm_(model.parameters(), 1)
+        scaler.step(optimizer)
+        scaler.update()
+    else:
+        if gradient_clipping:
+            clip_grad_norm_(model.parameters(), 1)
+        optimizer.step()
 
-    return with_cpu(loss)
+    return total_loss
 
 
 def evaluate_batch(config, batch, sample=False):
     model = config.get('model')
 
-    with torch.no_grad():
+    with torch.no_grad(), autocast(config.get('precision'), model.device):
         model.eval()
         if sample:
             ys, translations, attention_weights = model(batch, training=False, sample=True)
             loss = get_loss(config, batch, ys)
             return with_cpu(loss), translations, attention_weights
         else:
-            ys, translations = model(batch, training=False, sample=False)
+            ys = model(batch, teacher_forcing=1)
             loss = get_loss(config, batch, ys)
+            translations = decode(config, batch)
             return with_cpu(loss), translations
 
 
 def create_mask(batch_tuple):
     batch, lengths = batch_tuple
-    max_length, batch_size = batch.shape
-    mask = with_gpu(torch.ones(max_length, batch_size))
-    for i, length in enumerate(lengths):
-        mask[length:, i] = 0
-    return mask
+    max_length, _ = batch.shape
+    positions = torch.arange(max_length, device=lengths.device, dtype=lengths.dtype)
+    mask = positions.unsqueeze(1) < lengths.unsqueeze(0)
+    return mask.float()
 
 
 def compute_batch_loss(loss, mask, lengths):
@@ -175,9 +325,8 @@ def get_loss(config, batch, ys):
     mask = create_mask(batch.trg)
     target_batch, target_lengths = batch.trg
     T, batch_size = target_batch.shape
-    losses = with_gpu(torch.empty((T, batch_size), dtype=torch.float))
-    for i in range(T):
-        losses[i] = loss_fn(ys[i], target_batch[i])
+    losses = loss_fn(ys.view(T * batch_size, -1), target_batch.view(T * batch_size))
+    losses = losses.view(T, batch_size)
     loss = compute_batch_loss(losses, mask, target_lengths)
     return loss
 
@@ -187,7 +336,7 @@ def save_weights(config):
     model_path = f'{weights_path}/model'
     model = config.get('model')
     model_weights = model.state_dict()
-    torch.save(model_weights, model_path)
+    save_atomic(model_weights, model_path)
 
 
 if __name__ == '__main__':
@@ -1,7 +1,11 @@
+from copy import copy
+from device import with_cpu
 import math
 from random import random
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 
 class Encoder(nn.Module):
@@ -16,6 +20,7 @@ class Encoder(nn.Module):
         self.device = device
         self.hidden_size = rnn_config.get('hidden_size')
         self.num_layers = rnn_config.get('num_layers')
+        self.pack_sequences = rnn_config.get('pack_sequences', False)
 
         self.embedding = nn.Embedding(
             num_embeddings=source_vocabulary_size,
@@ -30,41 +35,58 @@ class Encoder(nn.Module):
 
     def forward(self, batch):
         source_batch, source_lengths = batch.src
-        target_batch, _ = batch.trg
         batch_size = source_batch.shape[1]
-        S = source_batch.size(0)
-        T = target_batch.size(0)
         input = self.pad_with_window_size(source_batch)
         embedded = self.embedding(input)
-        output, hidden = self.lstm(embedded)
-        context_indices = self.window_size + source_lengths - 1
+        if self.pack_sequences:
+            # trailing padding is not run through the lstm
+            packed_lengths = with_cpu(self.window_size + source_lengths)
+            packed = pack_padded_sequence(embedded, packed_lengths, enforce_sorted=False)
+            output, hidden = self.lstm(packed)
+            output, _ = pad_packed_sequence(output, total_length=input.size(0))
+        else:
+            output, hidden = self.lstm(embedded)
         # select last word of encoded output
-        context = torch.empty((1, batch_size, hidden[0].shape[2]), device=self.device)
-        for i in range(batch_size):
-            index = context_indices[i]
-            context[0, i] = output[index, i]
-        return output, hidden, context, S, T, batch_size
+        context_indices = self.window_size + source_lengths - 1
+        context_indices = context_indices.view(1, batch_size, 1).expand(1, batch_size, self.hidden_size)
+        context = output.gather(0, context_indices)
+        encoder_state = EncoderState(output, source_lengths, self.window_size)
+        return encoder_state, hidden, context
 
     def pad_with_window_size(self, batch):
-        size = batch.size()
-        n = len(size)
-        if n == 2:
-            length, batch_size = size
-            padded_length = length + (2 * self.window_size + 1)
-            padded = torch.empty((padded_length, batch_size), dtype=torch.long, device=self.device)
-            padded[:self.window_size, :] = self.pad
-            padded[self.window_size:self.window_size+length, :] = batch
-            padded[-(self.window_size+1):, :] = self.pad
-        elif n == 3:
-            length, batch_size, hidden = size
-            padded_length = length + (2 * self.window_size + 1)
-            padded = torch.empty((padded_length, batch_size, hidden), dtype=torch.long, device=self.device)
-            padded[:self.window_size, :, :] = self.pad
-            padded[self.window_size:self.window_size+length, :, :] = batch
-            padded[-(self.window_size+1):, :, :] = self.pad
-        else:
+        n = batch.dim()
+        if n not in (2, 3):
             raise Exception(f'Cannot pad batch with {n} dimensions.')
-        return padded
+        padding = (0, 0) * (n - 1) + (self.window_size, self.window_size + 1)
+        return F.pad(batch, padding, value=self.pad)
+
+
+class EncoderState:
+    """Source side tensors of a batch that stay fixed while decoding.
+
+    Built once per batch by the encoder and reused by the attention at every
+    decoding step (and by every hypothesis of a beam).
+    """
+
+    def __init__(self, output, lengths, window_size):
+        padded_length, batch_size, _ = output.shape
+        # batch_size x (window_size + S + window_size) x hidden
+        self.states = output.permute(1, 0, 2).contiguous()
+        self.lengths = lengths
+        # batch_size x 1
+        self.float_lengths = lengths.float().view(batch_size, 1)
+        # batch_size x 1 x (window_size + S + window_size)
+        positions = torch.arange(padded_length, device=lengths.device, dtype=lengths.dtype).view(1, 1, -1)
+        sentence_end = lengths.view(batch_size, 1, 1) + window_size
+        self.outside = (positions < window_size) | (positions >= sentence_end)
+
+    def index_select(self, indices):
+        encoder_state = copy(self)
+        encoder_state.states = self.states.index_select(0, indices)
+        encoder_state.lengths = self.lengths.index_select(0, indices)
+        encoder_state.float_lengths = self.float_lengths.index_select(0, indices)
+        encoder_state.outside = self.outside.index_select(0, indices)
+        return encoder_state
 
 
 class Decoder(nn.Module):
@@ -103,7 +125,7 @@ class Decoder(nn.Module):
             out_features=target_vocabulary_size,
         )
 
-    def forward(self, encoder_output, target_words, hidden, context, lengths, output_weights=False):
+    def forward(self, encoder_state, target_words, hidden, context, output_weights=False):
         T, batch_size = target_words.shape
         embedded = self.embedding(target_words)
         if self.input_feeding:
@@ -111,7 +133,7 @@ class Decoder(nn.Module):
         else:
             input = embedded
         output, hidden = self.lstm(input, hidden)
-        attention = self.attention(encoder_output, output, lengths, T, batch_size, output_weights)
+        attention = self.attention(encoder_state, output, T, batch_size, output_weights)
         if output_weights:
             c, weights = attention
         else:
@@ -139,13 +161,11 @@ class Attention(nn.Module):
         self.fc1 = nn.Linear(in_features=hidden_size, out_features=math.ceil(hidden_size / 2))
         self.fc2 = nn.Linear(in_features=math.ceil(hidden_size / 2), out_features=1)
 
-    def forward(self, encoder_output, decoder_output, lengths, T, batch_size, output_weights):
-        s0 = lengths[0].item()
-        lengths = lengths.view(batch_size, 1)
+    def forward(self, encoder_state, decoder_output, T, batch_size, output_weights):
         window_length = 2 * self.window_size + 1
         # h_s: batch_size x (window_size + S + window_size) x hidden
-        h_s = encoder_output
-        h_s = h_s.permute(1, 0, 2)
+        h_s = encoder_state.states
+        padded_length = h_s.size(1)
         # h_t: batch_size x T x hidden
         h_t = decoder_output
         h_t = h_t.permute(1, 0, 2)
@@ -154,45 +174,37 @@ class Attention(nn.Module):
         p = self.tanh(self.fc1(h_t))
         p = self.sigmoid(self.fc2(p))
         p = p.view(batch_size, T)
-        p = self.window_size + lengths.float() * p
+        p = self.window_size + encoder_state.float_lengths * p
         p = p.unsqueeze(2)
 
-        window_start = torch.round(p - self.window_size).int()
-        window_end = window_start + window_length
-        positions = torch.empty((batch_size, T, window_length), device=self.device, dtype=torch.float)
-        selection = torch.empty((batch_size, window_length, self.hidden_size), device=self.device, dtype=torch.float)
-        for i in range(batch_size):
-            for j in range(T):
-                start = window_start[i, j].item()
-                end = window_end[i, j].item()
-                positions[i, j] = torch.arange(start, end, device=self.device, dtype=torch.float)
-                selection[i] = h_s[i, start:end]
+        # batch_size x T x window_length
+        window_start = torch.round(p - self.window_size).long()
+        offsets = torch.arange(window_length, device=self.device, dtype=torch.long)
+        indices = window_start + offsets.view(1, 1, window_length)
+        positions = indices.float()
 
         # batch_size x T x window_length
         gaussian = torch.exp(-(positions - p) ** 2 / (2 * self.std_squared))
-        gaussian = gaussian.view(batch_size, T, window_length)
+
+        # gather the window of every target step, so the scores and the
+        # context only cover window_length encoder states
+        # batch_size x T x window_length x hidden
+        batch_offsets = torch.arange(batch_size, device=self.device).view(batch_size, 1, 1) * padded_length
+        windows = h_s.reshape(-1, self.hidden_size).index_select(0, (batch_offsets + indices).view(-1))
+        windows = windows.view(batch_size, T, window_length, self.hidden_size)
 
         # batch_size x T x window_length
         epsilon = 1e-14
-        score = self.score(selection, h_t)
-        for i in range(batch_size):
-            li = lengths[i].item()
-            for j in range(T):
-                start = window_start[i, j].item()
-                end = window_end[i, j].item()
-                if start < self.window_size:
-                    d = self.window_size - start
-                    score[i, j, :d] = epsilon
-                if end > li + self.window_size:
-                    d = (li + self.window_size) - end
-                    score[i, j, d:] = epsilon
+        score = self.score(windows, h_t)
+        outside = encoder_state.outside.expand(batch_size, T, padded_length).gather(2, indices)
+        score = score.masked_fill(outside, epsilon)
 
-        # batch_size x T x window_length
-        a = self.softmax(score)
+        # batch_size x T x window_length, the softmax runs in fp32 under autocast
+        a = self.softmax(score.float())
         a = a * gaussian
 
         # batch_size x T x hidden_size
-        c = torch.bmm(a, selection)
+        c = torch.matmul(a.unsqueeze(2), windows).squeeze(2)
 
         # T x batch_size x hidden_size
         c = c.permute(1, 0, 2)
@@ -201,43 +213,17 @@ class Attention(nn.Module):
             return c
 
         # insert weights of first sentence for eventual visualiation
-        weights = torch.zeros((T, s0), device=self.device, dtype=torch.float)
-        for j in range(T):
-            start = window_start[0, j].item()
-            end = window_end[0, j].item()
-            if start < self.window_size and end > self.window_size + s0:
-                # overflow in both ends
-                weights_start = 0
-                weights_end = s0
-                a_start = self.window_size - start
-                a_end = a_start + s0
-            elif start < self.window_size:
-                # overflow in left side only
-                weights_start = 0
-                weights_end = end - self.window_size
-                a_start = self.window_size - start
-                a_end = window_length
-            elif end > self.window_size + s0:
-                # overflow in right side only
-                weights_start = start - self.window_size
-                weights_end = s0
-                a_start = 0
-                a_end = a_start + (weights_end - weights_start)
-            else:
-                # a is contained in sentence
-                weights_start = start - self.window_size
-                weights_end = end - self.window_size
-                a_start = 0
-                a_end = window_length
-            weights[j, weights_start:weights_end] = a[0, j, a_start:a_end]
+        s0 = encoder_state.lengths[0].item()
+        banded = torch.zeros((T, padded_length), device=self.device, dtype=a.dtype)
+        banded.scatter_(1, indices[0], a[0])
+        weights = banded[:, self.window_size:self.window_size+s0]
 
         return c, weights
 
-    def score(self, h_s, h_t):
-        # h_s : batch x length x hidden
+    def score(self, windows, h_t):
+        # windows : batch x T x window_length x hidden
         # h_t : batch x T x hidden
-        h_s = h_s.transpose(1, 2)
-        return torch.bmm(h_t, h_s)
+        return torch.matmul(windows, h_t.unsqueeze(3)).squeeze(3)
 
 
 class Model(nn.Module):
@@ -253,8 +239,24 @@ class Model(nn.Module):
         self.pad_trg = config.get('PAD_trg')
         self.target_vocabulary_size = config.get('target_vocabulary_size')
 
-    def decode(self, encoder_output, input, hidden, context, lengths, batch_size, output_weights):
-        decoded = self.decoder(encoder_output, input, hidden, context, lengths, output_weights)
+    def encode(self, batch):
+        return self.encoder(batch)
+
+    def step(self, input, state):
+        encoder_state, hidden, context = state
+        y, hidden, context = self.decoder(encoder_state, input, hidden, context)
+        return y.squeeze(0), (encoder_state, hidden, context)
+
+    def reorder_state(self, state, indices, within_sentences=False):
+        # hypotheses of the same sentence share their encoder state
+        encoder_state, (h, c), context = state
+        if not within_sentences:
+            encoder_state = encoder_state.index_select(indices)
+        hidden = (h.index_select(1, indices), c.index_select(1, indices))
+        return encoder_state, hidden, context.index_select(1, indices)
+
+    def decode(self, encoder_state, input, hidden, context, batch_size, output_weights):
+        decoded = self.decoder(encoder_state, input, hidden, context, output_weights)
         if output_weights:
             y, hidden, context, attention = decoded
         else:
@@ -271,45 +273,57 @@ class Model(nn.Module):
     def forward(self, batch, **kwargs):
         training = kwargs.get('training', True)
         sample = kwargs.get('sample', False)
-        encoder_output, hidden, context, S, T, batch_size = self.encoder(batch)
-        _, source_lengths = batch.src
+        teacher_forcing = kwargs.get('teacher_forcing', self.teacher_forcing)
+        encoder_state, hidden, context = self.encoder(batch)
         target_batch, _ = batch.trg
+        T, batch_size = target_batch.shape
 
         ys = torch.empty(T, batch_size, self.target_vocabulary_size, dtype=torch.float, device=self.device)
         if training:
-            input = target_batch[0].unsqueeze(0)
-            for i in range(T):
-                if i != 0 and random() <= self.teacher_forcing:
-                    input = target_batch[i-1].unsqueeze(0)
-                y, input, hidden, context = self.decode(encoder_output, input, hidden, context, source_lengths, batch_size, False)
-                ys[i] = y
+            # gold input of every step (the first step is fed <sos>)
+            gold = torch.cat((target_batch[:1], target_batch[:-1]))
+            forced = [i == 0 or random() <= teacher_forcing for i in range(T)]
+            # consecutive teacher forced steps are decoded in a single pass, only steps fed
+            # a sampled word (or every step when using input feeding) start a new pass
+            starts = [i for i in range(T) if i == 0 or not forced[i] or self.decoder.input_feeding]
+            ends = starts[1:] + [T]
+            # words predicted at the last step of the previous pass, fed where teacher forcing is not used
+            previous_words = gold[:1]
+            for start, end in zip(starts, ends):
+                input_words = gold[start:end]
+                if not forced[start]:
+                    input_words = torch.cat((previous_words, input_words[1:]))
+                y, hidden, context = self.decoder(encoder_state, input_words, hidden, context)
+                ys[start:end] = y
+                _, topi = y[-1].topk(1)
+                previous_words = topi.detach().view(1, batch_size)
+                context = context[-1:].detach()
             return ys
         else:
             _, source_lengths = batch.src
             input = torch.tensor([[self.sos] * batch_size], device=self.device, dtype=torch.long)
-            translations = [[] for _ in range(batch_size)]
+            tokens = torch.empty((T, batch_size), device=self.device, dtype=torch.long)
             if sample:
                 first_sentence_has_reached_end = False
                 attention_weights = torch.zeros(0, source_lengths[0], device=self.device)
             for i in range(T):
-                decoded = self.decode(encoder_output, input, hidden, context, source_lengths, batch_size, sample)
+                decoded = self.decode(encoder_state, input, hidden, context, batch_size, sample)
                 if sample:
                     y, input, hidden, context, attention = decoded
                 else:
                     y, input, hidden, context = decoded
                 ys[i] = y
-
-                for j in range(batch_size):
-                    translations[j].append(input[0, j].item())
+                tokens[i] = input[0]
 
                 if sample:
                     # don't add padding to attention visualiation
-                    decoded_word = translations[0][i]
+                    decoded_word = input[0, 0].item()
                     if not first_sentence_has_reached_end and decoded_word != self.pad_trg:
                         # add attention weights of first sentence in batch
                         attention_weights = torch.cat((attention_weights, attention))
                         first_sentence_has_reached_end = decoded_word == self.eos
 
+            translations = with_cpu(tokens).t().tolist()
             if sample:
                 return ys, translations, attention_weights
             else:
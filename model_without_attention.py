@@ -1,6 +1,8 @@
+from device import with_cpu
 from random import random
 import torch
 import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 
 class Encoder(nn.Module):
@@ -13,6 +15,7 @@ class Encoder(nn.Module):
         self.device = device
         self.hidden_size = rnn_config.get('hidden_size')
         self.num_layers = rnn_config.get('num_layers')
+        self.pack_sequences = rnn_config.get('pack_sequences', False)
 
         self.embedding = nn.Embedding(
             num_embeddings=source_vocabulary_size,
@@ -29,11 +32,16 @@ class Encoder(nn.Module):
         source_batch, source_lengths = batch.src
         _, batch_size = source_batch.shape
         embedded = self.embedding(source_batch)
-        output, hidden = self.lstm(embedded)
-        context = torch.empty((1, batch_size, self.hidden_size), device=self.device)
-        for i in range(batch_size):
-            index = source_lengths[i] - 1
-            context[0, i] = output[index, i]
+        if self.pack_sequences:
+            # padding is not run through the lstm
+            packed = pack_padded_sequence(embedded, with_cpu(source_lengths), enforce_sorted=False)
+            output, hidden = self.lstm(packed)
+            output, _ = pad_packed_sequence(output, total_length=source_batch.size(0))
+        else:
+            output, hidden = self.lstm(embedded)
+        # select last word of encoded output
+        context_indices = (source_lengths - 1).view(1, batch_size, 1).expand(1, batch_size, self.hidden_size)
+        context = output.gather(0, context_indices)
         return context, hidden
 
 
@@ -67,6 +75,7 @@ class Decoder(nn.Module):
 
     def forward(self, input, context, hidden):
         output = self.embedding(input)
+        context = context.expand(output.size(0), -1, -1)
         output = torch.cat((output, context), 2)
         output, hidden = self.lstm(output, hidden)
         output = self.fc1(output)
@@ -84,6 +93,23 @@ class ModelWithoutAttention(nn.Module):
         self.teacher_forcing = config.get('teacher_forcing')
         self.eos = config.get('EOS')
         self.sos = config.get('SOS')
+        self.pad_trg = config.get('PAD_trg')
+
+    def encode(self, batch):
+        context, hidden = self.encoder(batch)
+        return context, hidden
+
+    def step(self, input, state):
+        context, hidden = state
+        y, hidden = self.decoder(input, context, hidden)
+        return y.squeeze(0), (context, hidden)
+
+    def reorder_state(self, state, indices, within_sentences=False):
+        # hypotheses of the same sentence share their encoder context
+        context, (h, c) = state
+        if not within_sentences:
+            context = context.index_select(1, indices)
+        return context, (h.index_select(1, indices), c.index_select(1, indices))
 
     def decode(self, input, context, hidden, batch_size):
         y, hidden = self.decoder(input, context, hidden)
@@ -95,6 +121,7 @@ class ModelWithoutAttention(nn.Module):
     def forward(self, batch, **kwargs):
         training = kwargs.get('training', True)
         sample = kwargs.get('sample', False)
+        teacher_forcing = kwargs.get('teacher_forcing', self.teacher_forcing)
 
         target_batch, _ = batch.trg
         T, batch_size = target_batch.shape
@@ -102,22 +129,33 @@ class ModelWithoutAttention(nn.Module):
         context, hidden = self.encoder(batch)
         ys = torch.empty(T, batch_size, self.target_vocabulary_size, dtype=torch.float, device=self.device)
         if training:
-            input = target_batch[0].unsqueeze(0)
-            for i in range(T):
-                if i != 0 and random() <= self.teacher_forcing:
-                    input = target_batch[i-1].unsqueeze(0)
-                y, input, hidden = self.decode(input, context, hidden, batch_size)
-                ys[i] = y
+            # gold input of every step (the first step is fed <sos>)
+            gold = torch.cat((target_batch[:1], target_batch[:-1]))
+            forced = [i == 0 or random() <= teacher_forcing for i in range(T)]
+            # consecutive teacher forced steps are decoded in a single pass,
+            # only steps fed a sampled word start a new pass
+            starts = [i for i in range(T) if i == 0 or not forced[i]]
+            ends = starts[1:] + [T]
+            # words predicted at the last step of the previous pass, fed where teacher forcing is not used
+            previous_words = gold[:1]
+            for start, end in zip(starts, ends):
+                input_words = gold[start:end]
+                if not forced[start]:
+                    input_words = torch.cat((previous_words, input_words[1:]))
+                y, hidden = self.decoder(input_words, context, hidden)
+                ys[start:end] = y
+                _, topi = y[-1].topk(1)
+                previous_words = topi.detach().view(1, batch_size)
             return ys
         else:
             input = torch.tensor([[self.sos] * batch_size], device=self.device, dtype=torch.long)
-            translations = [[] for _ in range(batch_size)]
+            tokens = torch.empty((T, batch_size), device=self.device, dtype=torch.long)
             for i in range(T):
                 y, input, hidden = self.decode(input, context, hidden, batch_size)
                 ys[i] = y
+                tokens[i] = input[0]
 
-                for j in range(batch_size):
-                    translations[j].append(input[0, j].item())
+            translations = with_cpu(tokens).t().tolist()
 
             if sample:
                 return ys, translations, None
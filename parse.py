@@ -1,18 +1,34 @@
 import argparse
 from data_loader import load_debug, load_dummy_fixed_length, load_dummy_variable_length, load_iwslt, load_multi30k
+from dataset import Vocabulary
+from device import (
+    all_reduce_sum,
+    check_precision,
+    configure_cpu,
+    get_grad_scaler,
+    get_rank,
+    get_world_size,
+    main_process_first,
+)
 import json
 from model import Model
 from model_without_attention import ModelWithoutAttention
 import os
+import random
 import torch
 import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
 import torch.optim as optim
 from utils import get_or_create_dir
 
 
+CPU_ARGUMENTS = ['affinity', 'interop_threads', 'threads']
+
+
 def get_config(use_gpu, device, device_idx, **kwargs):
     config_path = kwargs.get('config_path', None)
     load_weights = kwargs.get('load_weights', False)
+    model_data_dir = kwargs.get('model_data_dir', 'model-data')
     parse_args = kwargs.get('parse_args', True)
     if parse_args:
         args = parse_arguments()
@@ -22,6 +38,15 @@ def get_config(use_gpu, device, device_idx, **kwargs):
         config_path = args.config
     with open(config_path, 'r') as f:
         config = json.load(f)
+    # command line arguments override the cpu section of the configuration
+    cpu = config.get('cpu', {})
+    for key in CPU_ARGUMENTS:
+        value = kwargs.get(key, getattr(args, key, None))
+        if value is not None:
+            cpu[key] = value
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    config['cpu'] = configure_cpu(**cpu, local_rank=local_rank, local_world_size=local_world_size)
     EOS_token = '<eos>'
     PAD_token = '<pad>'
     SOS_token = '<sos>'
@@ -34,29 +59,35 @@ def get_config(use_gpu, device, device_idx, **kwargs):
     file_path = os.path.dirname(os.path.realpath(__file__))
     config['weights_path'] = get_or_create_dir(file_path, f'.weights/{name}')
     if load_weights:
-        model_data_path = get_or_create_dir(file_path, f'model-data/{name}')
+        model_data_path = get_or_create_dir(file_path, f'{model_data_dir}/{name}')
         config['model_data_path'] = model_data_path
-        language_path = f'{model_data_path}/language.json'
-        with open(language_path, 'r') as f:
-            language_data = json.load(f)
-        src_language = Language(language_data.get('source'))
-        trg_language = Language(language_data.get('target'))
+        src_language, trg_language = load_vocabularies(model_data_path)
     else:
         if args.debug:
-            train_iter, val_iter, src_language, trg_language, val_dataset = load_debug(config, device)
+            load = load_debug
         elif args.dummy_fixed_length:
-            train_iter, val_iter, src_language, trg_language, val_dataset = load_dummy_fixed_length(config, device)
+            load = load_dummy_fixed_length
         elif args.dummy_variable_length:
-            train_iter, val_iter, src_language, trg_language, val_dataset = load_dummy_variable_length(config, device)
+            load = load_dummy_variable_length
         elif args.iwslt:
-            train_iter, val_iter, src_language, trg_language, val_dataset = load_iwslt(config, device)
+            load = load_iwslt
         else:
-            train_iter, val_iter, src_language, trg_language, val_dataset = load_multi30k(config, device)
+            load = load_multi30k
+        # the first process builds the dataset cache, the others read it
+        with main_process_first():
+            train_iter, val_iter, src_language, trg_language, val_dataset = load(config, device)
+        world_size = get_world_size()
+        if world_size > 1:
+            rank = get_rank()
+            seed = all_reduce_sum(torch.tensor(random.randrange(2 ** 31) if rank == 0 else 0, device=device)).item()
+            train_iter = train_iter.shard(rank, world_size, seed, drop_last=True)
+            val_iter = val_iter.shard(rank, world_size)
         config['writer_path'] = get_or_create_dir(file_path, f'.logs/{config.get("name")}')
         config['train_iter'] = train_iter
         config['val_iter'] = val_iter
         config['val_dataset'] = val_dataset
         config['teacher_forcing'] = config.get('teacher_forcing', 0)
+        config['resume'] = args.resume
     config['source_vocabulary_size'] = len(src_language.itos)
     config['target_vocabulary_size'] = len(trg_language.itos)
     config['EOS'] = trg_language.stoi[EOS_token]
@@ -68,17 +99,28 @@ def get_config(use_gpu, device, device_idx, **kwargs):
     config['window_size'] = config.get('attention').get('window_size')
     config['input_feeding'] = config.get('input_feeding', False)
     config['use_attention'] = config.get('attention').get('enabled', True)
+    decoding = config.get('decoding', {})
+    config['beam_width'] = decoding.get('beam_width', 1)
+    config['length_penalty'] = decoding.get('length_penalty', 0)
+    config['max_length_ratio'] = decoding.get('max_length_ratio', 2)
+    config['precision'] = config.get('precision', 'fp32')
+    check_precision(config['precision'], device)
     if config.get('use_attention'):
         config['model'] = Model(config, device)
     else:
         config['model'] = ModelWithoutAttention(config, device)
     if use_gpu:
         config["model"] = config["model"].to(device)
+    if not load_weights and get_world_size() > 1:
+        # averages the gradients of all processes, the model itself is still used for everything but training
+        device_ids = [device_idx] if use_gpu else None
+        config['parallel_model'] = DistributedDataParallel(config['model'], device_ids=device_ids)
     if load_weights:
         model_path = f'{model_data_path}/model'
         config['model'].load_state_dict(torch.load(model_path, map_location=device))
     config['optimizer'] = get_optimizer(config.get('optimizer'), config['model'])
-    config['loss_fn'] = nn.CrossEntropyLoss()
+    config['loss_fn'] = nn.CrossEntropyLoss(reduction='none')
+    config['grad_scaler'] = get_grad_scaler(config['precision'])
     return config
 
 
@@ -102,6 +144,8 @@ def parse_arguments():
     parser.add_argument('--dummy_variable_length', type=str2bool, default=False, const=True, nargs='?', help=dummy_variable_length_help)
     parser.add_argument('--iwslt', type=str2bool, default=False, const=True, nargs='?', help=iwslt_help)
     parser.add_argument('--name', default=None, type=str, help='Name used when writing to tensorboard.')
+    parser.add_argument('--resume', type=str2bool, default=False, const=True, nargs='?', help='Resume from the newest checkpoint.')
+    add_cpu_arguments(parser)
     return parser.parse_args()
 
 
@@ -118,17 +162,45 @@ def get_optimizer(config, model):
         raise Exception(f'Unknown optimizer: {type}')
 
 
+def add_cpu_arguments(parser):
+    parser.add_argument('--threads', type=int, default=None, help='Intra-op threads (defaults to the cores per process).')
+    parser.add_argument('--interop_threads', type=int, default=None, help='Inter-op threads (defaults to 1).')
+    parser.add_argument('--affinity', type=str2bool, default=None, const=True, nargs='?', help='Pin each process to its cores.')
+
+
 class DummyArgs():
+    affinity = None
     config = None
     debug = False
     dummy_fixed_length = False
     dummy_variable_length = False
+    interop_threads = None
     iwslt = False
     name = None
+    resume = False
+    threads = None
+
+
+def load_vocabularies(model_data_path):
+    """Loads the source and target vocabularies saved with a model.
 
+    Only the itos lists are stored, stoi is rebuilt from them. Models saved
+    before vocabulary.json was introduced store both in language.json.
+    """
+    vocabulary_path = f'{model_data_path}/vocabulary.json'
+    if os.path.exists(vocabulary_path):
+        with open(vocabulary_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return Vocabulary(data.get('source')), Vocabulary(data.get('target'))
+    with open(f'{model_data_path}/language.json', 'r') as f:
+        data = json.load(f)
+    return Vocabulary(data.get('source').get('itos')), Vocabulary(data.get('target').get('itos'))
 
-class Language:
 
-    def __init__(self, data):
-        self.itos = data.get('itos')
-        self.stoi = data.get('stoi')
+def save_vocabularies(path, source_vocabulary, target_vocabulary):
+    data = {
+        'source': source_vocabulary.itos,
+        'target': target_vocabulary.itos,
+    }
+    with open(f'{path}/vocabulary.json', 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
@@ -0,0 +1,222 @@
+import argparse
+import asyncio
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from device import select_device
+import json
+from parse import add_cpu_arguments, get_config
+import time
+from translate import TOKENIZERS, translate
+
+
+STATUS_LINES = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    500: 'Internal Server Error',
+}
+
+
+def percentile(values, q):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class Metrics:
+
+    def __init__(self, window):
+        self.batch_sizes = Counter()
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.sentences = 0
+
+    def to_dict(self, queue_depth):
+        latencies = list(self.latencies)
+        p50 = percentile(latencies, 50)
+        p99 = percentile(latencies, 99)
+        return {
+            'queue_depth': queue_depth,
+            'requests': self.requests,
+            'sentences': self.sentences,
+            'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+            'latency_ms': {
+                'p50': None if p50 is None else p50 * 1000,
+                'p99': None if p99 is None else p99 * 1000,
+            },
+        }
+
+
+class MicroBatcher:
+    """Collects sentences of concurrent requests into batches bounded by size and waiting time.
+
+    Batches are translated one at a time in a worker thread so the event loop keeps
+    accepting requests while the model runs.
+    """
+
+    def __init__(self, config, tokenize, device, metrics, max_batch_size, max_wait, max_tokens):
+        self.config = config
+        self.tokenize = tokenize
+        self.device = device
+        self.metrics = metrics
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_tokens = max_tokens
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def translate(self, sentence):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((sentence, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(items) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.metrics.batch_sizes[len(items)] += 1
+            sentences = [sentence for sentence, _ in items]
+            try:
+                translations = await loop.run_in_executor(self.executor, self.translate_batch, sentences)
+            except Exception as exception:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(exception)
+                continue
+            for (_, future), translation in zip(items, translations):
+                if not future.done():
+                    future.set_result(translation)
+
+    def translate_batch(self, sentences):
+        return translate(self.config, map(self.tokenize, sentences), self.max_tokens, self.device)
+
+
+class TranslationServer:
+
+    def __init__(self, batcher, metrics):
+        self.batcher = batcher
+        self.metrics = metrics
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, response = await self.route(method, path, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                self.write_response(writer, status, response, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body):
+        if method == 'GET' and path == '/metrics':
+            return 200, self.metrics.to_dict(self.batcher.queue.qsize())
+        if method == 'POST' and path == '/translate':
+            return await self.translate(body)
+        return 404, {'error': f'Unknown endpoint: {method} {path}'}
+
+    async def translate(self, body):
+        start = time.perf_counter()
+        try:
+            data = json.loads(body.decode('utf-8'))
+            sentences = data.get('sentences', [])
+            if not isinstance(sentences, list) or not all(isinstance(sentence, str) for sentence in sentences):
+                raise ValueError('Expected a list of sentences.')
+        except (UnicodeDecodeError, ValueError, AttributeError) as exception:
+            return 400, {'error': str(exception)}
+        try:
+            translations = await asyncio.gather(*[self.batcher.translate(sentence) for sentence in sentences])
+        except Exception as exception:
+            return 500, {'error': str(exception)}
+        self.metrics.requests += 1
+        self.metrics.sentences += len(sentences)
+        self.metrics.latencies.append(time.perf_counter() - start)
+        return 200, {'translations': translations}
+
+    def write_response(self, writer, status, response, keep_alive):
+        body = json.dumps(response).encode('utf-8')
+        headers = [
+            f'HTTP/1.1 {status} {STATUS_LINES[status]}',
+            'Content-Type: application/json',
+            f'Content-Length: {len(body)}',
+            f'Connection: {"keep-alive" if keep_alive else "close"}',
+        ]
+        writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1') + body)
+
+
+def main():
+    args = parse_arguments()
+    use_gpu, device, device_idx = select_device()
+    config = get_config(
+        use_gpu,
+        device,
+        device_idx,
+        load_weights=True,
+        config_path=args.config,
+        model_data_dir=args.model_data_dir,
+        parse_args=False,
+        threads=args.threads,
+        interop_threads=args.interop_threads,
+        affinity=args.affinity,
+    )
+    try:
+        asyncio.run(serve(args, config, device))
+    except KeyboardInterrupt:
+        pass
+
+
+async def serve(args, config, device):
+    metrics = Metrics(args.latency_window)
+    tokenize = TOKENIZERS[args.tokenizer]
+    batcher = MicroBatcher(config, tokenize, device, metrics, args.max_batch_size, args.max_wait / 1000, args.max_tokens)
+    server = TranslationServer(batcher, metrics)
+    batching = asyncio.create_task(batcher.run())
+    listener = await asyncio.start_server(server.handle_connection, args.host, args.port)
+    print(f'Serving {config.get("name")} on http://{args.host}:{args.port}')
+    async with listener:
+        await asyncio.gather(listener.serve_forever(), batching)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Serve a trained translation model over HTTP.')
+    parser.add_argument('--config', type=str, nargs='?', default='configs/final.json', help='Path to model configuration.')
+    parser.add_argument('--model_data_dir', type=str, default='model-data', help='Directory with trained models.')
+    parser.add_argument('--tokenizer', type=str, default='de', choices=sorted(TOKENIZERS.keys()), help='Source tokenizer.')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Host to listen on.')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on.')
+    parser.add_argument('--max_batch_size', type=int, default=64, help='Maximum number of sentences per batch.')
+    parser.add_argument('--max_wait', type=float, default=10, help='Maximum milliseconds to wait for a batch to fill.')
+    parser.add_argument('--max_tokens', type=int, default=4096, help='Maximum number of source tokens per model call.')
+    parser.add_argument('--latency_window', type=int, default=10000, help='Number of requests kept for latency percentiles.')
+    add_cpu_arguments(parser)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import threading
+
+
+class BackgroundWriter:
+    """Writes to a tensorboardX SummaryWriter from a background thread.
+
+    Calls only append to an in-memory buffer, which the background thread
+    writes out every flush_seconds. Scalars may be device tensors, they are
+    read on the background thread so logging never waits for the device.
+    Figures are passed as functions that render them and are rendered on the
+    background thread too.
+    """
+
+    def __init__(self, log_dir, flush_seconds=1.0, **kwargs):
+        from tensorboardX import SummaryWriter
+        self.writer = SummaryWriter(log_dir=log_dir, **kwargs)
+        self.flush_seconds = flush_seconds
+        self.records = []
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, record):
+        with self.condition:
+            self.records.append(record)
+
+    def add_scalar(self, tag, value, step):
+        self.add(('scalar', tag, value, step))
+
+    def add_text(self, tag, text, step):
+        self.add(('text', tag, text, step))
+
+    def add_figure(self, tag, render, step):
+        """Logs the figure returned by render(), which is called on the background thread."""
+        self.add(('figure', tag, render, step))
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.closed:
+                    self.condition.wait(self.flush_seconds)
+                records = self.records
+                self.records = []
+                closed = self.closed
+            self.write(records)
+            if closed:
+                break
+
+    def write(self, records):
+        for kind, tag, value, step in records:
+            try:
+                if kind == 'scalar':
+                    self.writer.add_scalar(tag, float(value), step)
+                elif kind == 'text':
+                    self.writer.add_text(tag, value, step)
+                else:
+                    self.writer.add_figure(tag, value(), step)
+            except Exception as exception:
+                # a failing record should not stop the records after it from being written
+                print(f'Summary: could not write {tag} at step {step}: {exception}')
+        if len(records) > 0:
+            self.writer.flush()
+
+    def close(self):
+        """Writes the buffered records and closes the writer."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        self.writer.close()
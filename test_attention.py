@@ -0,0 +1,119 @@
+from model import Attention, EncoderState
+import torch
+
+
+def loop_attention(attention, encoder_output, decoder_output, lengths, T, batch_size, per_step):
+    """The per-element loop implementation Attention.forward replaced.
+
+    Unless per_step is set, every target step attends over the window of the
+    last step, as the loop did. This is only the same as its own window for T=1,
+    which is how the step-wise decoder called it.
+    """
+    window_size = attention.window_size
+    s0 = lengths[0].item()
+    lengths = lengths.view(batch_size, 1)
+    window_length = 2 * window_size + 1
+    h_s = encoder_output.permute(1, 0, 2)
+    h_t = decoder_output.permute(1, 0, 2)
+
+    p = attention.tanh(attention.fc1(h_t))
+    p = attention.sigmoid(attention.fc2(p))
+    p = p.view(batch_size, T)
+    p = window_size + lengths.float() * p
+    p = p.unsqueeze(2)
+
+    window_start = torch.round(p - window_size).int()
+    window_end = window_start + window_length
+    positions = torch.empty((batch_size, T, window_length), dtype=torch.float)
+    selection = torch.empty((batch_size, T, window_length, attention.hidden_size), dtype=torch.float)
+    for i in range(batch_size):
+        for j in range(T):
+            start = window_start[i, j].item()
+            end = window_end[i, j].item()
+            positions[i, j] = torch.arange(start, end, dtype=torch.float)
+            if per_step:
+                selection[i, j] = h_s[i, start:end]
+            else:
+                selection[i, :] = h_s[i, start:end]
+
+    gaussian = torch.exp(-(positions - p) ** 2 / (2 * attention.std_squared))
+
+    epsilon = 1e-14
+    score = (selection @ h_t.unsqueeze(3)).squeeze(3)
+    for i in range(batch_size):
+        li = lengths[i].item()
+        for j in range(T):
+            start = window_start[i, j].item()
+            end = window_end[i, j].item()
+            if start < window_size:
+                d = window_size - start
+                score[i, j, :d] = epsilon
+            if end > li + window_size:
+                d = (li + window_size) - end
+                score[i, j, d:] = epsilon
+
+    a = attention.softmax(score)
+    a = a * gaussian
+    c = (a.unsqueeze(2) @ selection).squeeze(2)
+    c = c.permute(1, 0, 2)
+
+    weights = torch.zeros((T, s0), dtype=torch.float)
+    for j in range(T):
+        start = window_start[0, j].item()
+        end = window_end[0, j].item()
+        if start < window_size and end > window_size + s0:
+            weights_start = 0
+            weights_end = s0
+            a_start = window_size - start
+            a_end = a_start + s0
+        elif start < window_size:
+            weights_start = 0
+            weights_end = end - window_size
+            a_start = window_size - start
+            a_end = window_length
+        elif end > window_size + s0:
+            weights_start = start - window_size
+            weights_end = s0
+            a_start = 0
+            a_end = a_start + (weights_end - weights_start)
+        else:
+            weights_start = start - window_size
+            weights_end = end - window_size
+            a_start = 0
+            a_end = window_length
+        weights[j, weights_start:weights_end] = a[0, j, a_start:a_end]
+    return c, weights
+
+
+def get_inputs(seed, S, T, batch_size, hidden_size, window_size):
+    generator = torch.Generator().manual_seed(seed)
+    lengths = torch.randint(1, S + 1, (batch_size,), generator=generator)
+    lengths[0] = S
+    encoder_output = torch.randn(S + 2 * window_size + 1, batch_size, hidden_size, generator=generator)
+    # large decoder outputs push the window centres to both ends of the sentences
+    decoder_output = 10 * torch.randn(T, batch_size, hidden_size, generator=generator)
+    return encoder_output, decoder_output, lengths
+
+
+def check_parity(T, per_step):
+    for seed in range(20):
+        S, batch_size, hidden_size, window_size = 3 + seed % 9, 1 + seed % 5, 8, 1 + seed % 4
+        torch.manual_seed(seed)
+        attention = Attention(window_size, hidden_size, torch.device('cpu'))
+        encoder_output, decoder_output, lengths = get_inputs(seed, S, T, batch_size, hidden_size, window_size)
+        encoder_state = EncoderState(encoder_output, lengths, window_size)
+        with torch.no_grad():
+            c, weights = attention(encoder_state, decoder_output, T, batch_size, True)
+            expected_c, expected_weights = loop_attention(
+                attention, encoder_output, decoder_output, lengths, T, batch_size, per_step
+            )
+        torch.testing.assert_close(c, expected_c)
+        torch.testing.assert_close(weights, expected_weights)
+
+
+def test_single_step_matches_loop():
+    check_parity(T=1, per_step=False)
+
+
+def test_every_step_attends_over_its_own_window():
+    check_parity(T=6, per_step=True)
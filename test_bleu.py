@@ -0,0 +1,54 @@
+from bleu import BleuAccumulator, compute_bleu, compute_bleu_from_statistics, get_corpus_statistics
+import numpy as np
+
+
+def get_corpus(seed, n):
+    random = np.random.RandomState(seed)
+    vocabulary_size = 2 + seed % 10
+    reference_corpus = []
+    translation_corpus = []
+    for _ in range(n):
+        references = [
+            random.randint(vocabulary_size, size=random.randint(1, 15)).tolist()
+            for _ in range(random.randint(1, 4))
+        ]
+        # translations copy most of a reference so higher order n-grams match too
+        translation = [
+            word if random.rand() > 0.3 else random.randint(vocabulary_size)
+            for word in references[random.randint(len(references))]
+        ]
+        translation = translation[:random.randint(len(translation) + 3)]
+        reference_corpus.append(references)
+        translation_corpus.append(translation)
+    return reference_corpus, translation_corpus
+
+
+def accumulate(reference_corpus, translation_corpus, smooth, batch_size=7):
+    bleu = BleuAccumulator(smooth=smooth)
+    for i in range(0, len(translation_corpus), batch_size):
+        bleu.add(reference_corpus[i:i+batch_size], translation_corpus[i:i+batch_size])
+    return bleu.score()
+
+
+def check_identical(smooth):
+    for seed in range(30):
+        reference_corpus, translation_corpus = get_corpus(seed, 1 + seed * 3)
+        expected = compute_bleu(reference_corpus, translation_corpus, smooth=smooth)
+        statistics = get_corpus_statistics(reference_corpus, translation_corpus, chunk_size=5)
+        assert compute_bleu_from_statistics(statistics, smooth=smooth) == expected
+        assert accumulate(reference_corpus, translation_corpus, smooth) == expected
+
+
+def test_statistics_match_compute_bleu():
+    check_identical(smooth=False)
+
+
+def test_smoothed_statistics_match_compute_bleu():
+    check_identical(smooth=True)
+
+
+def test_workers_match_single_process():
+    reference_corpus, translation_corpus = get_corpus(0, 200)
+    statistics = get_corpus_statistics(reference_corpus, translation_corpus, chunk_size=50)
+    parallel_statistics = get_corpus_statistics(reference_corpus, translation_corpus, workers=2, chunk_size=50)
+    assert (statistics == parallel_statistics).all()
@@ -0,0 +1,140 @@
+import argparse
+from collections import namedtuple
+from data_loader import tokenize_de, tokenize_dummy, tokenize_en
+from decoding import decode
+from device import select_device
+import itertools
+from parse import add_cpu_arguments, get_config
+import sys
+import time
+import torch
+from utils import batch2words, pad_sentences
+
+
+Batch = namedtuple('Batch', ['src'])
+
+TOKENIZERS = {
+    'de': tokenize_de,
+    'dummy': tokenize_dummy,
+    'en': tokenize_en,
+}
+
+
+def main():
+    args = parse_arguments()
+    use_gpu, device, device_idx = select_device()
+    config = get_config(
+        use_gpu,
+        device,
+        device_idx,
+        load_weights=True,
+        config_path=args.config,
+        model_data_dir=args.model_data_dir,
+        parse_args=False,
+        threads=args.threads,
+        interop_threads=args.interop_threads,
+        affinity=args.affinity,
+    )
+    tokenize = TOKENIZERS[args.tokenizer]
+    input_file = open(args.input, 'r') if args.input is not None else sys.stdin
+    output_file = open(args.output, 'w') if args.output is not None else sys.stdout
+
+    start = time.perf_counter()
+    n_sentences = 0
+    try:
+        lines = map(lambda line: line.rstrip('\n'), input_file)
+        while True:
+            # buffer a chunk of the stream, translate it in buckets and write it in the original order
+            sentences = list(itertools.islice(lines, args.buffer_size))
+            if len(sentences) == 0:
+                break
+            translations = translate(config, map(tokenize, sentences), args.max_tokens, device)
+            for translation in translations:
+                output_file.write(f'{translation}\n')
+            output_file.flush()
+            n_sentences += len(sentences)
+    finally:
+        if args.input is not None:
+            input_file.close()
+        if args.output is not None:
+            output_file.close()
+    seconds = time.perf_counter() - start
+    print(f'Translated {n_sentences} sentences in {seconds:.2f}s ({n_sentences / seconds:.1f} sentences/sec)', file=sys.stderr)
+
+
+def translate(config, tokenized_sentences, max_tokens, device):
+    """Translates tokenized sentences in length sorted batches of at most max_tokens source tokens.
+
+    Returns:
+        The translations as text in the order of the sentences.
+    """
+    model = config.get('model')
+    source_language = config.get('src_language')
+    target_language = config.get('trg_language')
+    EOS_token = config.get('EOS_token')
+    SOS_token = config.get('SOS_token')
+    EOS = config.get('EOS')
+    PAD = config.get('PAD_trg')
+    SOS = config.get('SOS')
+    unknown = source_language.stoi.get('<unk>')
+    sentences = [
+        [SOS_token] + sentence + [EOS_token]
+        for sentence in tokenized_sentences
+    ]
+    sentences = [
+        [source_language.stoi.get(word, unknown) for word in sentence]
+        for sentence in sentences
+    ]
+    translations = [None] * len(sentences)
+    model.eval()
+    with torch.no_grad():
+        for indices in get_buckets(sentences, max_tokens):
+            batch = create_batch(config, [sentences[i] for i in indices], device)
+            batch_translations = pad_sentences(decode(config, batch), PAD)
+            for i, words in zip(indices, batch2words(target_language, batch_translations, SOS, EOS, PAD)):
+                translations[i] = ' '.join(words)
+    return translations
+
+
+def get_buckets(sentences, max_tokens):
+    """Groups sentence indices by length so that a padded batch holds at most max_tokens tokens."""
+    order = sorted(range(len(sentences)), key=lambda i: len(sentences[i]), reverse=True)
+    buckets = []
+    bucket = []
+    for i in order:
+        # sentences are sorted by decreasing length, so the first one sets the padded length
+        padded_length = len(sentences[bucket[0]]) if len(bucket) > 0 else len(sentences[i])
+        if len(bucket) > 0 and (len(bucket) + 1) * padded_length > max_tokens:
+            buckets.append(bucket)
+            bucket = []
+        bucket.append(i)
+    if len(bucket) > 0:
+        buckets.append(bucket)
+    return buckets
+
+
+def create_batch(config, sentences, device):
+    PAD_src = config.get('PAD_src')
+    lengths = [len(sentence) for sentence in sentences]
+    source = torch.full((max(lengths), len(sentences)), PAD_src, dtype=torch.long)
+    for i, sentence in enumerate(sentences):
+        source[:len(sentence), i] = torch.tensor(sentence, dtype=torch.long)
+    lengths = torch.tensor(lengths, dtype=torch.long)
+    return Batch(src=(source.to(device), lengths.to(device)))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Translate sentences with a trained model.')
+    parser.add_argument('--config', type=str, nargs='?', default='configs/final.json', help='Path to model configuration.')
+    parser.add_argument('--model_data_dir', type=str, default='model-data', help='Directory with trained models.')
+    parser.add_argument('--input', type=str, default=None, help='File with one sentence per line (defaults to stdin).')
+    parser.add_argument('--output', type=str, default=None, help='File to write translations to (defaults to stdout).')
+    parser.add_argument('--tokenizer', type=str, default='de', choices=sorted(TOKENIZERS.keys()), help='Source tokenizer.')
+    parser.add_argument('--max_tokens', type=int, default=4096, help='Maximum number of source tokens per batch.')
+    parser.add_argument('--buffer_size', type=int, default=10000, help='Number of sentences read before translating.')
+    add_cpu_arguments(parser)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,73 @@
+import csv
 from device import with_cpu
 import itertools
+import numpy as np
 import os
-import pandas as pd
 import random
-from sklearn.model_selection import train_test_split
-import torchtext
+import tarfile
+import urllib.request
 
 
 def get_or_create_dir(base_path, dir_name):
     out_directory = os.path.join(base_path, dir_name)
-    if not os.path.exists(out_directory):
-        os.makedirs(out_directory)
+    os.makedirs(out_directory, exist_ok=True)
     return out_directory
 
 
+def download_and_extract(url, dir_path):
+    """Downloads a tar archive into dir_path, unless it is there already, and extracts it there."""
+    archive_path = os.path.join(dir_path, os.path.basename(url))
+    if not os.path.exists(archive_path):
+        print(f'Downloading {url}.')
+        urllib.request.urlretrieve(url, archive_path)
+    with tarfile.open(archive_path) as archive:
+        archive.extractall(dir_path)
+
+
+def strip_iwslt_tags(tags_path, path):
+    """Writes the sentences of an IWSLT train.tags file without the lines describing the talks."""
+    tags = ['<url', '<keywords', '<talkid', '<description', '<reviewer', '<translator', '<title', '<speaker']
+    with open(tags_path) as tags_file, open(path, 'w') as f:
+        for line in tags_file:
+            if not any(tag in line for tag in tags):
+                f.write(line.strip() + '\n')
+
+
+def read_parallel(source_path, target_path):
+    """Streams aligned sentence pairs of two files, skipping pairs with an empty side."""
+    with open(source_path) as source_file, open(target_path) as target_file:
+        for source, target in zip(source_file, target_file):
+            source = source.replace('\n', '')
+            target = target.replace('\n', '')
+            if source != '' and target != '':
+                yield source, target
+
+
+def write_csv(path, pairs):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['src', 'trg'])
+        writer.writerows(pairs)
+
+
+def write_split_csv(train_path, val_path, pairs, test_size=0.1):
+    """Writes every pair to the validation csv with probability test_size and to the train csv otherwise."""
+    with open(train_path, 'w', newline='') as train_file, open(val_path, 'w', newline='') as val_file:
+        train_writer = csv.writer(train_file, lineterminator='\n')
+        val_writer = csv.writer(val_file, lineterminator='\n')
+        train_writer.writerow(['src', 'trg'])
+        val_writer.writerow(['src', 'trg'])
+        for pair in pairs:
+            if random.random() < test_size:
+                val_writer.writerow(pair)
+            else:
+                train_writer.writerow(pair)
+
+
 def create_debug_csv():
     n_lines = 1000
-    with open('.data/iwslt/de-en/train.de-en.de') as f:
-        source = itertools.islice(f, n_lines)
-        source = map(lambda sentence: sentence.replace('\n', ''), source)
-        source = list(source)
-    with open('.data/iwslt/de-en/train.de-en.en') as f:
-        target = itertools.islice(f, n_lines)
-        target = map(lambda sentence: sentence.replace('\n', ''), target)
-        target = list(target)
-    data = {"src": source, "trg": target}
-    dataframe = pd.DataFrame(data, columns=['src', 'trg'])
-    train, val = train_test_split(dataframe, test_size=0.1)
-    train.to_csv('.data/debug/train.csv', index=False)
-    val.to_csv('.data/debug/val.csv', index=False)
+    pairs = read_parallel('.data/iwslt/de-en/train.de-en.de', '.data/iwslt/de-en/train.de-en.en')
+    write_split_csv('.data/debug/train.csv', '.data/debug/val.csv', itertools.islice(pairs, n_lines))
 
 
 def create_dummy_fixed_length_csv():
@@ -51,74 +90,18 @@ def create_dummy_fixed_length_csv():
         target = map(str, target)
         src.append(" ".join(source))
         trg.append(" ".join(target))
-    data = {"src": src, "trg": trg}
-    dataframe = pd.DataFrame(data, columns=['src', 'trg'])
-    train, val = train_test_split(dataframe, test_size=0.1)
-    train.to_csv('.data/dummy_fixed_length/train.csv', index=False)
-    val.to_csv('.data/dummy_fixed_length/val.csv', index=False)
+    write_split_csv('.data/dummy_fixed_length/train.csv', '.data/dummy_fixed_length/val.csv', zip(src, trg))
 
 
 def create_iwslt():
-    with open('.data/iwslt/de-en/train.de-en.de') as f:
-        source = f.readlines()
-        source = map(lambda sentence: sentence.replace('\n', ''), source)
-        source = filter(lambda sentence: sentence != '', source)
-        source = list(source)
-    with open('.data/iwslt/de-en/train.de-en.en') as f:
-        target = f.readlines()
-        target = map(lambda sentence: sentence.replace('\n', ''), target)
-        target = filter(lambda sentence: sentence != '', target)
-        target = list(target)
-    data = {"src": source, "trg": target}
-    dataframe = pd.DataFrame(data, columns=['src', 'trg'])
-    train, val = train_test_split(dataframe, test_size=0.1)
-    train.to_csv('.data/iwslt/train.csv', index=False)
-    val.to_csv('.data/iwslt/val.csv', index=False)
+    pairs = read_parallel('.data/iwslt/de-en/train.de-en.de', '.data/iwslt/de-en/train.de-en.en')
+    write_split_csv('.data/iwslt/train.csv', '.data/iwslt/val.csv', pairs)
 
 
 def create_multi30k():
-    with open('.data/multi30k/train.en') as f:
-        train_src = f.readlines()
-        train_src = map(lambda sentence: sentence.replace('\n', ''), train_src)
-        train_src = filter(lambda sentence: sentence != '', train_src)
-        train_src = list(train_src)
-    with open('.data/multi30k/train.de') as f:
-        train_trg = f.readlines()
-        train_trg = map(lambda sentence: sentence.replace('\n', ''), train_trg)
-        train_trg = filter(lambda sentence: sentence != '', train_trg)
-        train_trg = list(train_trg)
-    train = {"src": train_src, "trg": train_trg}
-    train = pd.DataFrame(train, columns=['src', 'trg'])
-
-    with open('.data/multi30k/val.en') as f:
-        val_src = f.readlines()
-        val_src = map(lambda sentence: sentence.replace('\n', ''), val_src)
-        val_src = filter(lambda sentence: sentence != '', val_src)
-        val_src = list(val_src)
-    with open('.data/multi30k/val.de') as f:
-        val_trg = f.readlines()
-        val_trg = map(lambda sentence: sentence.replace('\n', ''), val_trg)
-        val_trg = filter(lambda sentence: sentence != '', val_trg)
-        val_trg = list(val_trg)
-    val = {"src": val_src, "trg": val_trg}
-    val = pd.DataFrame(val, columns=['src', 'trg'])
-
-    with open('.data/multi30k/test2016.en') as f:
-        test_src = f.readlines()
-        test_src = map(lambda sentence: sentence.replace('\n', ''), test_src)
-        test_src = filter(lambda sentence: sentence != '', test_src)
-        test_src = list(test_src)
-    with open('.data/multi30k/test2016.de') as f:
-        test_trg = f.readlines()
-        test_trg = map(lambda sentence: sentence.replace('\n', ''), test_trg)
-        test_trg = filter(lambda sentence: sentence != '', test_trg)
-        test_trg = list(test_trg)
-    test = {"src": test_src, "trg": test_trg}
-    test = pd.DataFrame(test, columns=['src', 'trg'])
-
-    train.to_csv('.data/multi30k/train.csv', index=False)
-    val.to_csv('.data/multi30k/val.csv', index=False)
-    test.to_csv('.data/multi30k/test.csv', index=False)
+    for split, file_name in [('train', 'train'), ('val', 'val'), ('test', 'test2016')]:
+        pairs = read_parallel(f'.data/multi30k/{file_name}.en', f'.data/multi30k/{file_name}.de')
+        write_csv(f'.data/multi30k/{split}.csv', pairs)
 
 
 def create_dummy_variable_length_csv():
@@ -137,64 +120,49 @@ def create_dummy_variable_length_csv():
         target = map(str, target)
         src.append(" ".join(source))
         trg.append(" ".join(target))
-    data = {"src": src, "trg": trg}
-    dataframe = pd.DataFrame(data, columns=['src', 'trg'])
-    train, val = train_test_split(dataframe, test_size=0.1)
-    train.to_csv('.data/dummy_variable_length/train.csv', index=False)
-    val.to_csv('.data/dummy_variable_length/val.csv', index=False)
-
-
-def load_from_csv(config, csv_dir_path, source_tokenizer, target_tokenizer, device):
-    print(f'Data loader: Started ({csv_dir_path}).')
-
-    EOS_token = config.get('EOS_token')
-    PAD_token = config.get('PAD_token')
-    SOS_token = config.get('SOS_token')
-
-    source_field = torchtext.data.Field(
-        tokenize=source_tokenizer,
-        init_token=SOS_token,
-        eos_token=EOS_token,
-        pad_token=PAD_token,
-        include_lengths=True
-    )
-    target_field = torchtext.data.Field(
-        tokenize=target_tokenizer,
-        init_token=SOS_token,
-        eos_token=EOS_token,
-        pad_token=PAD_token,
-        include_lengths=True
-    )
-    data_fields = [('src', source_field), ('trg', target_field)]
-
-    print('Data loader: Making splits.')
-    train, val = torchtext.data.TabularDataset.splits(
-        path=csv_dir_path,
-        train='train.csv',
-        validation='val.csv',
-        format='csv',
-        fields=data_fields,
-        skip_header=True
-    )
-    source_vocabulary_size = config.get('source_vocabulary_size')
-    target_vocabulary_size = config.get('target_vocabulary_size')
-
-    print('Data loader: Building vocabulary.')
-    source_field.build_vocab(train, val, max_size=source_vocabulary_size)
-    target_field.build_vocab(train, val, max_size=target_vocabulary_size)
-
-    print('Data loader: Iterator splits splits.')
-    train_iter, val_iter = torchtext.data.BucketIterator.splits(
-        (train, val),
-        batch_size=config.get('batch_size'),
-        device=device,
-        shuffle=True,
-        sort_key=lambda x: len(x.src)
-    )
-
-    print('Data loader: Finished.')
-
-    return train_iter, val_iter, source_field.vocab, target_field.vocab, val
+    write_split_csv('.data/dummy_variable_length/train.csv', '.data/dummy_variable_length/val.csv', zip(src, trg))
+
+
+def pad_sentences(sentences, PAD):
+    """Stacks token index lists of different lengths into a batch x length array padded with PAD."""
+    batch = np.full((len(sentences), max(map(len, sentences), default=0)), PAD, dtype=np.int64)
+    for i, sentence in enumerate(sentences):
+        batch[i, :len(sentence)] = sentence
+    return batch
+
+
+def get_sentence_masks(batch, SOS, EOS, PAD):
+    """Masks the tokens of a batch x length array of token indices that belong to the sentences.
+
+    Sentences end before their first <eos> or <pad> and <sos> is dropped.
+    """
+    _, max_length = batch.shape
+    end = (batch == EOS) | (batch == PAD)
+    lengths = np.where(end.any(1), end.argmax(1), max_length)
+    return (np.arange(max_length) < lengths[:, None]) & (batch != SOS)
+
+
+def batch2ids(batch, SOS, EOS, PAD):
+    """Converts a batch x length array of token indices to a list of token indices for every sentence."""
+    batch = np.asarray(batch)
+    if batch.shape[1] == 0:
+        return [[] for _ in range(len(batch))]
+    masks = get_sentence_masks(batch, SOS, EOS, PAD)
+    return [sentence[mask].tolist() for sentence, mask in zip(batch, masks)]
+
+
+def batch2words(language, batch, SOS, EOS, PAD):
+    """Converts a batch x length array of token indices to a list of words for every sentence.
+
+    Sentences end before their first <eos> or <pad> and <sos> is dropped. The
+    words of the whole batch are looked up at once in language.words.
+    """
+    batch = np.asarray(batch)
+    if batch.shape[1] == 0:
+        return [[] for _ in range(len(batch))]
+    masks = get_sentence_masks(batch, SOS, EOS, PAD)
+    words = language.words[batch]
+    return [sentence[mask].tolist() for sentence, mask in zip(words, masks)]
 
 
 def list2words(language, sentence):
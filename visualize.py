@@ -1,10 +1,11 @@
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 import numpy as np
 
 
 def visualize_attention(source_words, translation_words, attention_weights):
+    # matplotlib is only imported once a figure is drawn
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
     attention_weights = attention_weights.numpy()
     n = len(source_words)
     m = len(translation_words)